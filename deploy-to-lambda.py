@@ -5,11 +5,17 @@
 # copy the Lambda relevant files to a seperate folder then deploy from the new 
 # folder.
 # 
-# Usage: `python deploy-to-lambda.py`
+# Usage: `python deploy-to-lambda.py [--with-snapshots]`
+#
+# With --with-snapshots, your library lists are fetched from Kodi now and
+# shipped with the function, so a cold Lambda container can answer straight
+# away instead of downloading the whole library first.  This needs Kodi to be
+# reachable with the settings in .env, and the packages in requirements.txt.
 
 import subprocess
 import os
 import shutil
+import sys
 
 app_name = "kodi-alexa"
 
@@ -30,5 +36,12 @@ if(os.path.isfile("wsgi.py")):
 if(os.path.isfile("requirements.txt")):
   shutil.copy("requirements.txt", app_name)
 
+if "--with-snapshots" in sys.argv:
+  os.environ["KODI_SNAPSHOT_DIR"] = os.path.abspath(os.path.join(app_name, "snapshots"))
+  os.mkdir(os.environ["KODI_SNAPSHOT_DIR"])
+  import wsgi
+  wsgi.setup_env()
+  print "Bundled library snapshots: %s" % (", ".join(wsgi.kodi.SaveLibrarySnapshots()) or "none, is Kodi reachable?")
+
 os.chdir(app_name)
 print subprocess.Popen("lambda-deploy deploy", shell=True, stdout=subprocess.PIPE).stdout.read()  
\ No newline at end of file
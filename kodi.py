@@ -26,52 +26,32 @@ THE SOFTWARE.
 
 # For a complete discussion, see http://forum.kodi.tv/showthread.php?tid=254502
 
+import array
+import codecs
+import collections
+import contextlib
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
-import requests
+import mmap
 import time
 import urllib
 import os
+import Queue
 import random
 import re
+import socket
 import string
+import struct
 import sys
-import pycountry
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-
-
-# These are words that we ignore when doing a non-exact match on show names
-STOPWORDS = [
-  "a",
-  "about",
-  "an",
-  "and",
-  "are",
-  "as",
-  "at",
-  "be",
-  "by",
-  "for",
-  "from",
-  "how",
-  "in",
-  "is",
-  "it",
-  "of",
-  "on",
-  "or",
-  "that",
-  "the",
-  "this",
-  "to",
-  "was",
-  "what",
-  "when",
-  "where",
-  "will",
-  "with",
-]
+import threading
+import unicodedata
+
+# requests, fuzzywuzzy, pycountry and websocket are imported where they're
+# used instead of up here.  Most commands need few or none of them, and
+# importing them all would slow down every cold start.
 
 
 # Very naive method to remove a leading "the" from the given string
@@ -98,46 +78,840 @@ def http_normalize_slashes(url):
   return normalized_url
 
 
+# A small thread-safe cache that forgets the least recently used entries once
+# it holds more than max_size, and entries older than ttl seconds if given.
+class LRUCache(object):
+  def __init__(self, max_size, ttl=None):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        return default
+      if self.ttl is not None and time.time() - entry[1] > self.ttl:
+        return default
+      self.entries[key] = entry
+      return entry[0]
+
+  def set(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (value, time.time())
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def discard(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+# Connection settings, resolved from the environment once per process.
+#
+# We don't use the fallback param in os.getenv() because AWS Lambda actually
+# sets any environment variables included in LAMBDA_ENV_VARS, regardless if
+# it was unset before.
+#
+# Furthermore, os.getenv() under AWS Lambda returns 'None' as a string
+# instead of None as NoneType as we'd normally expect, so we have to
+# explicitly test for that.
+KodiConfig = collections.namedtuple('KodiConfig', [
+  'url',
+  'auth',
+  'pool_size',
+  'timeouts',
+  'transport',
+  'socket_address',
+  'socket_url',
+  'socket_idle',
+  'player_ttl',
+  'volume_ttl',
+  'library_mirror',
+  'library_ttl',
+  'library_refresh',
+  'snapshot_dir',
+  'fire_and_forget',
+])
+
+_config = None
+_config_lock = threading.Lock()
+
+# Connection pool shared by every call to SendCommand.  Reusing a keep-alive
+# connection means only the first JSON-RPC call pays for the TCP (and TLS, if
+# KODI_SCHEME is https) handshake; everything after that is one round trip.
+_session = None
+
+
+def _env_string(name, default):
+  value = os.getenv(name)
+  if not value or value == 'None':
+    return default
+  return value
+
+
+# Read a numeric tuning value from the environment, falling back to the
+# default if it's unset or garbage.
+def _env_number(name, default, cast=float):
+  value = _env_string(name, None)
+  if value is None:
+    return default
+  try:
+    return cast(value)
+  except ValueError:
+    print "Ignoring invalid value %s for %s" % (value, name)
+    return default
+
+
+def _build_config():
+  # Do not use below for your own settings, use the .env file
+  scheme = _env_string('KODI_SCHEME', 'http')
+  subpath = _env_string('KODI_SUBPATH', '')
+  address = _env_string('KODI_ADDRESS', '127.0.0.1')
+  port = _env_string('KODI_PORT', '8080')
+  username = _env_string('KODI_USERNAME', 'kodi')
+  password = _env_string('KODI_PASSWORD', 'kodi')
+  transport = _env_string('KODI_TRANSPORT', 'http').lower()
+  tcp_port = _env_number('KODI_TCP_PORT', 9090, int)
+
+  # Join the environment variables into a url and remove any double slashes
+  url = http_normalize_slashes("%s://%s:%s/%s/%s" % (scheme, address, port, subpath, 'jsonrpc'))
+
+  return KodiConfig(
+    url=url,
+    auth=(username, password),
+    # Number of connections kept open per Kodi host.  Gunicorn runs one
+    # request per worker by default, but threaded workers and the background
+    # helpers can talk to Kodi concurrently.
+    pool_size=_env_number('KODI_POOL_SIZE', 4, int),
+    # (connect, read) timeouts in seconds.  Library scans and cleans can take
+    # a while to answer, so the read timeout is fairly generous.
+    timeouts=(_env_number('KODI_CONNECT_TIMEOUT', 5.0), _env_number('KODI_READ_TIMEOUT', 60.0)),
+    # 'http' (the default), or 'tcp'/'ws' to send commands over one
+    # long-lived connection to Kodi's raw TCP or WebSocket interface.
+    transport=transport,
+    socket_address=(address, tcp_port),
+    socket_url='ws://%s:%d/jsonrpc' % (address, tcp_port),
+    # Reconnect before sending if the socket has been quiet for this many
+    # seconds, since tunnels and NAT routers silently drop idle connections.
+    socket_idle=_env_number('KODI_SOCKET_IDLE', 120.0),
+    # How long the list of active players is trusted when there is no
+    # notification connection to keep it up to date.
+    player_ttl=_env_number('KODI_PLAYER_TTL', 3.0),
+    # Likewise for the volume, which can be changed from Kodi's own remote.
+    volume_ttl=_env_number('KODI_VOLUME_TTL', 3.0),
+    # Keep a copy of the library lists in memory, and how often to ask Kodi
+    # whether they changed when there is no notification connection.
+    library_mirror=_env_string('KODI_LIBRARY_MIRROR', 'true').lower() not in ('false', 'no', '0'),
+    library_ttl=_env_number('KODI_LIBRARY_TTL', 15.0),
+    # ...and how often to fetch them again in full in the background, to
+    # pick up edits that don't change a collection's size.
+    library_refresh=_env_number('KODI_LIBRARY_REFRESH', 600.0),
+    # Where to keep library snapshot files that every worker process on
+    # this machine can share.  Unset means none are written, though ones
+    # bundled with the code (see deploy-to-lambda.py) are still read.
+    snapshot_dir=_env_string('KODI_SNAPSHOT_DIR', None),
+    # Let control intents answer before Kodi has carried out the command.
+    # Lambda freezes as soon as it has answered, so it's off there.
+    fire_and_forget=_env_string('KODI_FIRE_AND_FORGET', 'false' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else 'true').lower() not in ('false', 'no', '0'),
+  )
+
+
+def _build_session(config):
+  import requests
+
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=config.pool_size)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  session.headers.update({'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+  return session
+
+
+# Splits a stream of concatenated JSON texts, as sent by Kodi's raw TCP
+# interface, into the individual texts.  Only brackets and strings are looked
+# at; the texts themselves are parsed by json.loads afterwards.
+_JSON_TOKEN = re.compile(r'[{}\[\]"]')
+_JSON_STRING_TAIL = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+
+class JSONSplitter(object):
+  def __init__(self):
+    self.buffer = u''
+    self.pos = 0
+    self.depth = 0
+    self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+  def feed(self, data):
+    self.buffer += self.decoder.decode(data)
+    texts = []
+    while True:
+      m = _JSON_TOKEN.search(self.buffer, self.pos)
+      if not m:
+        self.pos = len(self.buffer)
+        break
+      if m.group() == '"':
+        tail = _JSON_STRING_TAIL.match(self.buffer, m.end())
+        if not tail:
+          # Wait for the rest of the string
+          self.pos = m.start()
+          break
+        self.pos = tail.end()
+        continue
+      self.pos = m.end()
+      if m.group() in '{[':
+        self.depth += 1
+      else:
+        self.depth -= 1
+        if self.depth == 0:
+          texts.append(self.buffer[:self.pos])
+          self.buffer = self.buffer[self.pos:]
+          self.pos = 0
+    return texts
+
+
+# Picks the entries of one array out of a JSON document as the document
+# streams in, e.g. path ('result', 'songs') for a GetSongs response.  Each
+# entry is decoded on its own and everything before it is thrown away, so
+# only one entry's worth of text is ever held.  The entries must be objects
+# or arrays, which library lists always are.  done is set once the whole
+# document has been seen, and error if it has a top level "error" member.
+class JSONArrayScanner(object):
+  def __init__(self, path):
+    self.path = list(path)
+    self.buffer = u''
+    self.pos = 0
+    self.depth = 0
+    self.keys = []
+    self.array_depth = None
+    self.item_start = None
+    self.error = False
+    self.done = False
+    self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+  def feed(self, data):
+    self.buffer += self.decoder.decode(data)
+    items = []
+    while True:
+      m = _JSON_TOKEN.search(self.buffer, self.pos)
+      if not m:
+        self.pos = len(self.buffer)
+        break
+      if m.group() == '"':
+        tail = _JSON_STRING_TAIL.match(self.buffer, m.end())
+        if not tail or (self.item_start is None and not self.buffer[tail.end():].strip()):
+          # Wait for the rest of the string, and whatever follows a
+          # possible object key
+          self.pos = m.start()
+          break
+        self.pos = tail.end()
+        if self.item_start is None and self.buffer[self.pos:].lstrip().startswith(':'):
+          del self.keys[self.depth - 1:]
+          self.keys.append(json.loads(self.buffer[m.start():self.pos]))
+          if self.depth == 1 and self.keys == ['error']:
+            self.error = True
+        continue
+
+      self.pos = m.end()
+      if m.group() in '{[':
+        if self.array_depth is not None and self.depth == self.array_depth and self.item_start is None:
+          self.item_start = m.start()
+        elif m.group() == '[' and self.keys == self.path and self.depth == len(self.path):
+          self.array_depth = self.depth + 1
+        self.depth += 1
+      else:
+        self.depth -= 1
+        if self.item_start is not None and self.depth == self.array_depth:
+          items.append(json.loads(self.buffer[self.item_start:self.pos]))
+          self.item_start = None
+        elif self.array_depth is not None and self.depth < self.array_depth:
+          self.array_depth = None
+        if self.depth == 0:
+          self.done = True
+
+    # Forget everything that has been dealt with
+    keep = self.item_start if self.item_start is not None else self.pos
+    self.buffer = self.buffer[keep:]
+    self.pos -= keep
+    if self.item_start is not None:
+      self.item_start = 0
+    return items
+
+
+# Callbacks for Kodi notifications (Player.OnPlay, VideoLibrary.OnUpdate, ...).
+# These only arrive over the tcp and ws transports.
+_notification_listeners = []
+
+
+# callback(method, data) is called on the transport's reader thread, so it
+# must be quick and must not send commands to Kodi itself.
+def AddNotificationListener(callback):
+  _notification_listeners.append(callback)
+
+
+def _notify(method, data):
+  for callback in list(_notification_listeners):
+    try:
+      callback(method, data)
+    except Exception as e:
+      print "Notification listener failed for %s: %s" % (method, e)
+
+
+# After failing to connect to Kodi's tcp or ws port, go straight to HTTP for
+# this many seconds rather than waiting for the connect timeout every call
+SOCKET_RETRY_DELAY = 30
+
+
+# Sends JSON-RPC over one persistent connection to Kodi's raw TCP or
+# WebSocket interface.  Any number of threads can have calls in flight at
+# once; each call gets its own request id on the wire and a reader thread
+# hands responses back to the waiting callers by that id.  Messages without an
+# id are notifications and are passed to the notification listeners.
+class SocketTransport(object):
+  def __init__(self, config):
+    self.config = config
+    self.conn = None
+    self.last_traffic = 0
+    self.last_failure = 0
+    self.ids = itertools.count(1)
+    self.pending = {}
+    self.lock = threading.Lock()
+    self.send_lock = threading.Lock()
+
+  @property
+  def connected(self):
+    return self.conn is not None
+
+  def _connect(self):
+    connect_timeout = self.config.timeouts[0]
+    if self.config.transport == 'ws':
+      try:
+        import websocket
+      except ImportError:
+        raise IOError("KODI_TRANSPORT=ws needs the websocket-client package")
+      conn = websocket.create_connection(self.config.socket_url, timeout=connect_timeout)
+      conn.settimeout(None)
+      send, recv = conn.send, conn.recv
+    else:
+      conn = socket.create_connection(self.config.socket_address, connect_timeout)
+      conn.settimeout(None)
+      conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+      send, recv = conn.sendall, lambda: conn.recv(65536)
+
+    self.conn = conn
+    self.send = send
+    self.last_traffic = time.time()
+    reader = threading.Thread(target=self._read, args=(conn, recv))
+    reader.daemon = True
+    reader.start()
+    print "Connected to Kodi via %s" % (self.config.transport)
+
+  def _read(self, conn, recv):
+    splitter = JSONSplitter()
+    try:
+      while True:
+        data = recv()
+        if not data:
+          break
+        if isinstance(data, unicode):
+          data = data.encode('utf-8')
+        self.last_traffic = time.time()
+        for text in splitter.feed(data):
+          self._dispatch(json.loads(text))
+    except Exception as e:
+      print "Kodi %s connection lost: %s" % (self.config.transport, e)
+    self._disconnect(conn)
+
+  def _dispatch(self, message):
+    if isinstance(message, list):
+      for one_message in message:
+        self._dispatch(one_message)
+    elif message.get('id') is not None:
+      with self.lock:
+        waiter = self.pending.get(message['id'])
+      if waiter:
+        waiter[1][message['id']] = message
+        waiter[0].set()
+    elif 'method' in message:
+      _notify(message['method'], message.get('params', {}).get('data'))
+
+  def _disconnect(self, conn):
+    with self.lock:
+      if self.conn is not conn:
+        return
+      self.conn = None
+      # Wake up everyone still waiting; they'll find their response missing.
+      for waiter in self.pending.values():
+        waiter[0].set()
+    try:
+      conn.close()
+    except Exception:
+      pass
+
+  def close(self):
+    if self.conn is not None:
+      self._disconnect(self.conn)
+
+  # Returns the decoded response, {} if Kodi didn't answer in time, or None
+  # if the command couldn't be sent at all (so the caller can fall back).
+  def call(self, command):
+    request = json.loads(command)
+    requests_list = request if isinstance(request, list) else [request]
+
+    with self.send_lock:
+      if self.conn is not None and time.time() - self.last_traffic > self.config.socket_idle:
+        self.close()
+      if self.conn is None:
+        if time.time() - self.last_failure < SOCKET_RETRY_DELAY:
+          return None
+        try:
+          self._connect()
+        except Exception as e:
+          print "Could not connect to Kodi via %s: %s" % (self.config.transport, e)
+          self.last_failure = time.time()
+          return None
+
+      # Swap in our own ids so concurrent callers can't collide
+      waiter = (threading.Event(), {})
+      original_ids = {}
+      with self.lock:
+        for one_request in requests_list:
+          wire_id = next(self.ids)
+          original_ids[wire_id] = one_request.get('id')
+          one_request['id'] = wire_id
+          self.pending[wire_id] = waiter
+
+      try:
+        self.send(json.dumps(request))
+        self.last_traffic = time.time()
+      except Exception as e:
+        print "Could not send to Kodi via %s: %s" % (self.config.transport, e)
+        self._forget(original_ids)
+        self._disconnect(self.conn)
+        return None
+
+    deadline = time.time() + self.config.timeouts[1]
+    while len(waiter[1]) < len(original_ids) and self.conn is not None:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      waiter[0].wait(remaining)
+      waiter[0].clear()
+    self._forget(original_ids)
+
+    responses = []
+    for wire_id, original_id in sorted(original_ids.items()):
+      response = waiter[1].get(wire_id)
+      if response is not None:
+        response['id'] = original_id
+        responses.append(response)
+
+    if not isinstance(request, list):
+      return responses[0] if responses else {}
+    return responses
+
+  def _forget(self, wire_ids):
+    with self.lock:
+      for wire_id in wire_ids:
+        self.pending.pop(wire_id, None)
+
+
+_socket_transport = None
+
+
+def GetSocketTransport():
+  config = GetConfig()
+  if config.transport not in ('tcp', 'ws'):
+    return None
+  return _socket_transport
+
+
+def GetConfig():
+  if _config is None:
+    ReloadConfig()
+  return _config
+
+
+# Re-read the connection settings from the environment.  Call this after
+# changing any of the KODI_* variables in a running process.
+def ReloadConfig():
+  global _config, _session, _socket_transport
+
+  with _config_lock:
+    config = _build_config()
+    old_session, old_transport = _session, _socket_transport
+    # The session is only set up once something is sent over HTTP
+    _config, _session, _socket_transport = config, None, SocketTransport(config)
+  if old_session is not None:
+    old_session.close()
+  if old_transport is not None:
+    old_transport.close()
+  return config
+
+
+def GetSession():
+  global _session
+
+  config = GetConfig()
+  if _session is None:
+    with _config_lock:
+      if _session is None:
+        _session = _build_session(config)
+  return _session
+
+
+# How much of a streamed response to read at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# Methods that only ask Kodi something, besides the many Get methods
+READ_ONLY_METHODS = set([
+  'JSONRPC.Introspect',
+  'JSONRPC.Permission',
+  'JSONRPC.Ping',
+  'JSONRPC.Version',
+])
+
+
+# Whether a JSON-RPC method leaves Kodi as it was
+def IsReadOnly(method):
+  return method.partition('.')[2].startswith('Get') or method in READ_ONLY_METHODS
+
+
+# Whether every call in a command (or batch of commands) is read-only
+def IsReadOnlyCommand(command):
+  request = json.loads(command)
+  if not isinstance(request, list):
+    request = [request]
+  return all([IsReadOnly(one_request.get('method', '')) for one_request in request])
+
+
+# Sends the commands that change something in one Kodi host (apart from
+# LONG_RUNNING_METHODS) from a single thread, in the order they were
+# queued, so that e.g. two "volume up"s can't both read the same volume
+# before either has set it.  Whatever piles up while a command is on its
+# way to Kodi goes out together on the next round: runs of volume changes
+# are worked out to the one volume they end at, seek steps cancel out to
+# the net number of steps, and navigation (moving around menus, pictures
+# or the playlist) goes as a single batch.
+class CommandQueue(object):
+  def __init__(self, url):
+    self.url = url
+    self.queue = Queue.Queue()
+    thread = threading.Thread(target=self._work)
+    thread.daemon = True
+    thread.start()
+
+  def put(self, entry):
+    self.queue.put(entry)
+    return entry
+
+  def _work(self):
+    while True:
+      pending = [self.queue.get()]
+      try:
+        while True:
+          pending.append(self.queue.get_nowait())
+      except Queue.Empty:
+        pass
+
+      # Entries that can't be combined with anything get a group to themselves
+      for kind, run in itertools.groupby(pending, lambda entry: entry.kind or id(entry)):
+        run = list(run)
+        try:
+          if kind == 'volume':
+            self._send_volume(run)
+          elif kind == 'seek':
+            self._send_seek(run)
+          elif kind == 'navigation' and len(run) > 1:
+            responses = self._send_batch([entry.request for entry in run])
+            for entry, response in zip(run, responses):
+              entry.finish(response)
+          else:
+            for entry in run:
+              entry.finish(_SendCommandNow(entry.command))
+        except Exception as e:
+          print "Could not send %s: %s" % (', '.join([entry.describe() for entry in run]), e)
+          for entry in run:
+            entry.fail(e)
+
+  def _send_batch(self, requests):
+    batch = RPCBatch()
+    for request in requests:
+      batch.add(request['method'], request.get('params'))
+    return batch.responses(_SendCommandNow(batch.command()))
+
+  # Everything before the last time the volume was set outright is moot
+  def _send_volume(self, run):
+    absolute = [i for i, entry in enumerate(run) if entry.volume is not None]
+    if absolute:
+      start = absolute[-1]
+      volume = run[start].volume
+    else:
+      # Nothing set it outright, so start from where it is now
+      start = -1
+      volume = _volume_state.get()
+      if volume is None:
+        data = _SendCommandNow(RPCString("Application.GetProperties", {"properties":["volume"]}))
+        if 'result' not in data:
+          for entry in run:
+            entry.finish(data)
+          return
+        volume = data['result']['volume']
+    for entry in run[start + 1:]:
+      volume = entry.change(volume)
+
+    data = _SendCommandNow(RPCString("Application.SetVolume", {"volume":volume}))
+    if isinstance(data.get('result'), int):
+      _volume_state.set(data['result'])
+    else:
+      _volume_state.invalidate()
+    for entry in run:
+      entry.finish(data)
+
+  def _send_seek(self, run):
+    steps = collections.OrderedDict()
+    for entry in run:
+      size, direction = SEEK_STEPS[entry.request['params']['value']]
+      key = (entry.request['params']['playerid'], size)
+      steps[key] = steps.get(key, 0) + direction
+
+    requests = []
+    for (playerid, size), count in steps.items():
+      value = size + ('forward' if count > 0 else 'backward')
+      requests.extend([{"method":"Player.Seek", "params":{"playerid":playerid, "value":value}}] * abs(count))
+
+    # Everyone gets the answer to the last step; if the steps cancel out,
+    # there's nothing to send
+    data = {}
+    if len(requests) == 1:
+      data = _SendCommandNow(RPCString(requests[0]['method'], requests[0]['params']))
+    elif requests:
+      data = self._send_batch(requests)[-1]
+    for entry in run:
+      entry.finish(data)
+
+
+# Player.Seek steps, by size and direction
+SEEK_STEPS = {
+  'smallforward': ('small', 1),
+  'smallbackward': ('small', -1),
+  'bigforward': ('big', 1),
+  'bigbackward': ('big', -1),
+}
+
+# Commands Kodi can take minutes to answer.  These skip the CommandQueue so
+# that a library clean doesn't hold up play/pause, volume and the like.
+LONG_RUNNING_METHODS = set([
+  'AudioLibrary.Clean',
+  'AudioLibrary.Scan',
+  'VideoLibrary.Clean',
+  'VideoLibrary.Scan',
+])
+
+
+def IsLongRunningCommand(command):
+  request = json.loads(command)
+  return isinstance(request, dict) and request.get('method') in LONG_RUNNING_METHODS
+
+
+# Commands that only move around, which the CommandQueue batches together
+NAVIGATION_METHODS = set([
+  'Input.Up',
+  'Input.Down',
+  'Input.Left',
+  'Input.Right',
+  'Player.Move',
+])
+NAVIGATION_ACTIONS = set(['pageup', 'pagedown'])
+
+
+# Which commands a command can be combined with in the CommandQueue:
+# 'volume', 'seek', 'navigation' or None.
+def CommandKind(request):
+  if isinstance(request, list):
+    return None
+  method = request.get('method')
+  params = request.get('params') or {}
+  if method == 'Application.SetVolume' and isinstance(params.get('volume'), int):
+    return 'volume'
+  if method == 'Player.Seek' and params.get('value') in SEEK_STEPS:
+    return 'seek'
+  if method in NAVIGATION_METHODS:
+    return 'navigation'
+  if method == 'Input.ExecuteAction' and params.get('action') in NAVIGATION_ACTIONS:
+    return 'navigation'
+  if method == 'Player.GoTo' and params.get('to') in ('next', 'previous'):
+    return 'navigation'
+  return None
+
+
+# A command waiting in a CommandQueue
+class QueuedCommand(object):
+  def __init__(self, command, kind=None):
+    self.command = command
+    self.request = None
+    self.kind = kind
+    self.volume = None
+    if command is not None:
+      self.request = json.loads(command)
+      self.kind = CommandKind(self.request)
+      if self.kind == 'volume':
+        self.volume = self.request['params']['volume']
+    self.response = {}
+    self.error = None
+    self.sent = threading.Event()
+
+  def describe(self):
+    return self.command
+
+  def finish(self, response):
+    self.response = response
+    if isinstance(response, dict) and 'error' in response:
+      print "Kodi refused %s: %s" % (self.describe(), response['error'])
+    self.sent.set()
+
+  def fail(self, error):
+    self.error = error
+    self.sent.set()
+
+  # Blocks until Kodi has answered, and returns the answer
+  def wait(self):
+    self.sent.wait()
+    if self.error is not None:
+      raise self.error
+    return self.response
+
+
+# Moves the volume relative to wherever it is when the queue gets to it.
+# change takes the volume and returns the new one.
+class VolumeChange(QueuedCommand):
+  def __init__(self, name, change):
+    QueuedCommand.__init__(self, None, 'volume')
+    self.name = name
+    self.change = change
+
+  def describe(self):
+    return self.name
+
+
+_command_queues = {}
+_command_queues_lock = threading.Lock()
+
+
+def GetCommandQueue():
+  url = GetConfig().url
+  with _command_queues_lock:
+    command_queue = _command_queues.get(url)
+    if command_queue is None:
+      command_queue = _command_queues[url] = CommandQueue(url)
+  return command_queue
+
+
+_dispatch = threading.local()
+
+
+# While this is in effect, commands that change something in Kodi are
+# queued for the CommandQueue and SendCommand returns {} straight away.
+# Anything that only asks Kodi something still waits for the answer.  Use
+# it around code that doesn't look at what the changes returned, e.g.:
+#
+#   with FireAndForget():
+#     Back()
+@contextlib.contextmanager
+def FireAndForget():
+  previous = getattr(_dispatch, 'fire_and_forget', False)
+  _dispatch.fire_and_forget = GetConfig().fire_and_forget
+  try:
+    yield
+  finally:
+    _dispatch.fire_and_forget = previous
+
+
+# Puts an entry on the CommandQueue and, unless we're in FireAndForget(),
+# waits for Kodi's answer to it.
+def QueueCommand(entry):
+  GetCommandQueue().put(entry)
+  if getattr(_dispatch, 'fire_and_forget', False):
+    return {}
+  return entry.wait()
+
+
+class PendingCall(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+# Read-only commands that are on their way to Kodi.  A thread asking exactly
+# what another thread is already asking waits for that answer instead of
+# sending the same request again, so several Echos wanting every movie at
+# once cost one download.  They all get the same decoded answer, so callers
+# mustn't change what they get back.
+class SingleFlight(object):
+  def __init__(self):
+    self.calls = {}
+    self.lock = threading.Lock()
+
+  def run(self, key, function):
+    with self.lock:
+      call = self.calls.get(key)
+      first = call is None
+      if first:
+        call = self.calls[key] = PendingCall()
+
+    if not first:
+      call.done.wait()
+      if call.error is None:
+        return call.result
+      # The first caller gave up with an exception; have a go ourselves
+      return function()
+
+    try:
+      call.result = function()
+    except Exception as e:
+      call.error = e
+      raise
+    finally:
+      with self.lock:
+        del self.calls[key]
+      call.done.set()
+    return call.result
+
+
+_in_flight = SingleFlight()
+
+
 # These two methods construct the JSON-RPC message and send it to the Kodi player
 def SendCommand(command):
-  # Do not use below for your own settings, use the .env file
+  if IsReadOnlyCommand(command):
+    return _in_flight.run((GetConfig().url, command), lambda: _SendCommandNow(command))
+  if IsLongRunningCommand(command):
+    return _SendCommandNow(command)
+  return QueueCommand(QueuedCommand(command))
+
+
+def _SendCommandNow(command):
+  config = GetConfig()
 
-  # We don't use the fallback param in os.getenv() because AWS Lambda actually
-  # sets any environment variables included in LAMBDA_ENV_VARS, regardless if
-  # it was unset before.
-  #
-  # Furthermore, os.getenv() under AWS Lambda returns 'None' as a string
-  # instead of None as NoneType as we'd normally expect, so we have to
-  # explicitly test for that.
-  SCHEME = os.getenv('KODI_SCHEME')
-  if not SCHEME or SCHEME == 'None':
-    SCHEME = 'http'
-  SUBPATH = os.getenv('KODI_SUBPATH')
-  if not SUBPATH or SUBPATH == 'None':
-    SUBPATH = ''
-  KODI = os.getenv('KODI_ADDRESS')
-  if not KODI or KODI == 'None':
-    KODI = '127.0.0.1'
-  PORT = os.getenv('KODI_PORT')
-  if not PORT or PORT == 'None':
-    PORT = '8080'
-  USER = os.getenv('KODI_USERNAME')
-  if not USER or USER == 'None':
-    USER = 'kodi'
-  PASS = os.getenv('KODI_PASSWORD')
-  if not PASS or PASS == 'None':
-    PASS = 'kodi'
-
-  # Join the environment variables into a url
-  url = "%s://%s:%s/%s/%s" % (SCHEME, KODI, PORT, SUBPATH, 'jsonrpc')
-
-  # Remove any double slashes in the url
-  url = http_normalize_slashes(url)
-
-  print "Sending request to %s" % (url)
+  transport = GetSocketTransport()
+  if transport is not None:
+    data = transport.call(command)
+    if data is not None:
+      return data
+    # Couldn't reach the socket interface; fall back to HTTP
+
+  print "Sending request to %s" % (config.url)
 
   try:
-    r = requests.post(url, data=command, auth=(USER, PASS))
+    r = GetSession().post(config.url, data=command, auth=config.auth, timeout=config.timeouts)
   except:
     return {}
   if r.status_code == 401:
@@ -146,13 +920,77 @@ def SendCommand(command):
   return json.loads(r.text)
 
 
-def RPCString(method, params=None):
-  j = {"jsonrpc":"2.0", "method":method, "id":1}
+# Sends a command over HTTP and yields the entries of result[key] one at a
+# time as the response arrives, rather than decoding the whole thing at
+# once.  Use it for lists that can get big, like every song in the library.
+# Nothing is yielded if Kodi couldn't be reached or answered with an error.
+def StreamCommand(command, key, scanner=None):
+  import requests
+
+  config = GetConfig()
+  print "Streaming request to %s" % (config.url)
+
+  try:
+    r = GetSession().post(config.url, data=command, auth=config.auth, timeout=config.timeouts, stream=True)
+  except:
+    return
+  if r.status_code == 401:
+    r.close()
+    print "Unauthorized. Please set environemnt variables KODI_USERNAME and KODI_PASSWORD."
+    raise SystemError("Unauthorized. Please set environemnt variables KODI_USERNAME and KODI_PASSWORD.")
+
+  if scanner is None:
+    scanner = JSONArrayScanner(['result', key])
+  try:
+    for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+      for item in scanner.feed(chunk):
+        yield item
+  except requests.exceptions.RequestException as e:
+    print "Streaming from Kodi failed: %s" % (e)
+    scanner.error = True
+  finally:
+    r.close()
+
+
+def RPCString(method, params=None, id=1):
+  j = {"jsonrpc":"2.0", "method":method, "id":id}
   if params:
     j["params"] = params
   return json.dumps(j)
 
 
+# Collects several JSON-RPC calls and sends them to Kodi as one array batch.
+# Kodi runs the calls in the order they were added and answers with an array
+# of responses, which send() matches back up by id.  Failed calls don't stop
+# the rest of the batch; their entry in the result simply holds the error.
+class RPCBatch(object):
+  def __init__(self):
+    self.calls = []
+
+  def add(self, method, params=None):
+    self.calls.append((method, params))
+    return self
+
+  def command(self):
+    return '[%s]' % (','.join([RPCString(method, params, id) for id, (method, params) in enumerate(self.calls, 1)]))
+
+  # Returns one response per call, in the order the calls were added.  A call
+  # that got no response (e.g., Kodi couldn't be reached) gets an empty dict.
+  def send(self):
+    if not self.calls:
+      return []
+
+    return self.responses(SendCommand(self.command()))
+
+  # Matches Kodi's answer to command() back up with the calls
+  def responses(self, data):
+    responses = {}
+    if isinstance(data, list):
+      for response in data:
+        responses[response.get('id')] = response
+    return [responses.get(id, {}) for id in range(1, len(self.calls) + 1)]
+
+
 # Function to convert numbers to words
 def word_form(number):
   # based on stackoverflow answer from https://github.com/ralphembree/Loquitor
@@ -211,52 +1049,349 @@ def replaceDigits(phrase):
   return wordified[:-1]
 
 
-# Match heard string to something in the results
-def matchHeard(heard, results, lookingFor='label'):
-  located = None
+RE_PARENTHESES = re.compile(r'\([^)]*\)')
+
+
+# The forms of a name that heard phrases are compared against: the name with
+# non-ascii symbols and punctuation stripped and lowercased, the same minus a
+# leading "the", and the name minus anything in parentheses.
+def normalized_forms(name):
+  ascii_name = name.encode('ascii', 'replace')
+  result_name = str(ascii_name).lower().translate(None, string.punctuation)
+  removed_paren = RE_PARENTHESES.sub('', ascii_name).rstrip().lower().translate(None, string.punctuation)
+  return result_name, remove_the(result_name), removed_paren
+
+
+# Phonetic keys
+#
+# Speech recognition gets names wrong in ways that sound right ("kesha" for
+# "Ke$ha", "sigur ross" for "Sigur Ros"), which edit distance doesn't always
+# forgive.  Each word is reduced to a Metaphone code, so names that sound
+# alike end up with the same key.
+
+VOWELS = 'AEIOU'
+
+# Symbols that are pronounced, rather than being punctuation
+PHONETIC_SYMBOLS = [(u'$', u's'), (u'&', u' and '), (u'+', u' plus '), (u'@', u' at ')]
+
+
+def metaphone(word):
+  word = ''.join([c for c in word.upper() if 'A' <= c <= 'Z'])
+  if not word:
+    return ''
+  if word[:2] in ('AE', 'GN', 'KN', 'PN', 'WR'):
+    word = word[1:]
+  elif word[0] == 'X':
+    word = 'S' + word[1:]
+  elif word[:2] == 'WH':
+    word = 'W' + word[2:]
+
+  code = []
+  n = len(word)
+  for i, c in enumerate(word):
+    prev = word[i - 1] if i > 0 else ''
+    next = word[i + 1] if i + 1 < n else ''
+    after = word[i + 2] if i + 2 < n else ''
+    if c == prev and c != 'C':
+      continue
+    if c in VOWELS:
+      if i == 0:
+        code.append(c)
+    elif c == 'B':
+      if not (prev == 'M' and i == n - 1):
+        code.append('B')
+    elif c == 'C':
+      if next == 'H':
+        code.append('K' if prev == 'S' else 'X')
+      elif next == 'I' and after == 'A':
+        code.append('X')
+      elif next in ('I', 'E', 'Y'):
+        if prev != 'S':
+          code.append('S')
+      else:
+        code.append('K')
+    elif c == 'D':
+      code.append('J' if next == 'G' and after in ('E', 'I', 'Y') else 'T')
+    elif c == 'G':
+      if next == 'H' and after and after not in VOWELS:
+        continue
+      if next == 'N' and (i + 2 == n or word[i + 2:] == 'ED'):
+        continue
+      if prev == 'D' and next in ('E', 'I', 'Y'):
+        continue
+      code.append('J' if next in ('I', 'E', 'Y') and prev != 'G' else 'K')
+    elif c == 'H':
+      if prev not in ('C', 'S', 'P', 'T', 'G') and next and next in VOWELS:
+        code.append('H')
+    elif c == 'K':
+      if prev != 'C':
+        code.append('K')
+    elif c == 'P':
+      code.append('F' if next == 'H' else 'P')
+    elif c == 'Q':
+      code.append('K')
+    elif c == 'S':
+      code.append('X' if next == 'H' or (next == 'I' and after in ('O', 'A')) else 'S')
+    elif c == 'T':
+      if next == 'I' and after in ('O', 'A'):
+        code.append('X')
+      elif next == 'H':
+        code.append('0')
+      elif not (next == 'C' and after == 'H'):
+        code.append('T')
+    elif c == 'V':
+      code.append('F')
+    elif c in ('W', 'Y'):
+      if next and next in VOWELS:
+        code.append(c)
+    elif c == 'X':
+      code.append('KS')
+    elif c == 'Z':
+      code.append('S')
+    else:
+      code.append(c)
+  return ''.join(code)
+
+
+# The Metaphone codes of each word of a name, after dropping accents, spelling
+# out digits and pronounceable symbols, and ignoring a leading "the".
+def phonetic_words(name):
+  if isinstance(name, str):
+    name = name.decode('utf-8', 'ignore')
+  name = unicodedata.normalize('NFKD', name.lower())
+  for symbol, spoken in PHONETIC_SYMBOLS:
+    name = name.replace(symbol, spoken)
+  name = u''.join([c if c.isalnum() else u' ' for c in name if not unicodedata.combining(c)])
+
+  words = []
+  for word in remove_the(name).split():
+    if word.isdigit():
+      # isdigit() is true of superscripts and other scripts' digits too
+      try:
+        words.extend(word_form(''.join([str(unicodedata.digit(c)) for c in word])).split())
+      except ValueError:
+        words.append(word)
+    else:
+      words.append(word)
+  return [key for key in [metaphone(word) for word in words] if key]
+
+
+# How many rows sharing the most sounds with what was heard the fuzzy match
+# scores along with its trigram shortlist
+PHONETIC_CANDIDATES = 10
+
+
+# How many of the most promising rows the fuzzy match scores first (plus
+# any tied with the last of them).  Lists shorter than this are scored in
+# full, and so is any list where none of those rows match.
+FUZZY_CANDIDATES = 50
+
+# Fuzzy matches need to score better than this
+FUZZY_THRESHOLD = 75
+
+
+# Character trigrams of each word, padded so word boundaries count too
+def trigrams(processed_name):
+  grams = set()
+  for word in processed_name.split():
+    word = ' %s ' % (word)
+    for i in range(len(word) - 2):
+      grams.add(word[i:i + 3])
+  return grams
+
+
+# Lookup tables over one list of results, so the simple matches in
+# matchHeard are dictionary lookups instead of a pass over every row, and the
+# fuzzy match only scores the rows sounding like or sharing the most trigrams
+# with what was heard.  Build one per list with GetMatchIndex, which reuses it for as long
+# as the library mirror keeps the same table.
+class MatchIndex(object):
+  def __init__(self, results, lookingFor='label'):
+    self.results = results
+    self.lookingFor = lookingFor
+    self.processed = None
+    self.gram_counts = None
+    self.postings = None
+    self.phonetic_keys = None
+    self.phonetic_postings = None
+    self.exact = {}
+    self.minus_the = {}
+    self.minus_paren = {}
+    for position, result in enumerate(results):
+      result_name, result_minus_the, removed_paren = normalized_forms(result[lookingFor])
+      # The first row with a given name wins, as it always has
+      self.exact.setdefault(result_name, position)
+      self.minus_the.setdefault(result_minus_the, position)
+      self.minus_paren.setdefault(removed_paren, position)
+
+  def simple_match(self, heard):
+    if heard in self.exact:
+      print 'Simple match on direct comparison'
+      return self.results[self.exact[heard]]
+    heard_minus_the = remove_the(heard)
+    if heard_minus_the in self.minus_the:
+      print 'Simple match minus "the"'
+      return self.results[self.minus_the[heard_minus_the]]
+    if heard in self.minus_paren:
+      print 'Simple match minus parentheses'
+      return self.results[self.minus_paren[heard]]
+    return None
 
-  heard_minus_the = remove_the(heard)
-  print 'Trying to match: ' + heard
-  sys.stdout.flush()
-  heard_list = set([x for x in heard.split() if x not in STOPWORDS])
+  # Only built the first time a fuzzy match is needed
+  def _build_fuzzy(self):
+    from fuzzywuzzy import utils as fuzz_utils
+
+    processed = [fuzz_utils.full_process(result[self.lookingFor], force_ascii=True) for result in self.results]
+    gram_counts = array.array('I')
+    postings = {}
+    for position, name in enumerate(processed):
+      grams = trigrams(name)
+      gram_counts.append(len(grams))
+      for gram in grams:
+        postings.setdefault(gram, []).append(position)
+    # postings last, since that's what tells other threads it's built
+    self.processed, self.gram_counts, self.postings = processed, gram_counts, postings
+
+  def _build_phonetic(self):
+    keys = {}
+    postings = {}
+    for position, result in enumerate(self.results):
+      words = phonetic_words(result[self.lookingFor])
+      keys.setdefault(' '.join(words), []).append(position)
+      for word in set(words):
+        postings.setdefault(word, []).append(position)
+    # keys last, since that's what tells other threads it's built
+    self.phonetic_postings, self.phonetic_keys = postings, keys
+
+  # The rows that sound exactly like what was heard, and the few sharing the
+  # most sounds with it
+  def _phonetic_candidates(self, heard):
+    words = phonetic_words(heard)
+    if not words:
+      return set()
+
+    counts = {}
+    for word in set(words):
+      for position in self.phonetic_postings.get(word, ()):
+        counts[position] = counts.get(position, 0) + 1
+    candidates = set(heapq.nlargest(PHONETIC_CANDIDATES, counts, key=lambda position: (counts[position], -position)))
+    candidates.update(self.phonetic_keys.get(' '.join(words), []))
+    return candidates
+
+  # Rows ranked by how alike their trigrams and a phrase's are (the Dice
+  # coefficient), so a long name sharing a few common trigrams doesn't push
+  # out a short one sharing most of them.
+  def _candidates(self, phrases):
+    if len(self.results) <= FUZZY_CANDIDATES:
+      return range(len(self.results))
+
+    similarity = {}
+    for phrase in phrases:
+      grams = trigrams(phrase)
+      shared = {}
+      for gram in grams:
+        for position in self.postings.get(gram, ()):
+          shared[position] = shared.get(position, 0) + 1
+      for position, count in shared.iteritems():
+        dice = 2.0 * count / (len(grams) + self.gram_counts[position])
+        if dice > similarity.get(position, 0):
+          similarity[position] = dice
+
+    if len(similarity) > FUZZY_CANDIDATES:
+      cutoff = heapq.nlargest(FUZZY_CANDIDATES, similarity.itervalues())[-1]
+      return [position for position, dice in similarity.iteritems() if dice >= cutoff]
+    return similarity.keys()
+
+  # Score what was heard, and what was heard with digits spelled out, against
+  # the rows that sound like it and the rows sharing the most trigrams with
+  # it, in one pass, so the best scoring of them wins whichever way it was
+  # found.  Every row is scored only if none of those match.  A good score
+  # for the phrase as heard wins over a better score for the spelled-out
+  # version.
+  def fuzzy_match(self, heard):
+    from fuzzywuzzy import utils as fuzz_utils
+
+    if self.postings is None:
+      self._build_fuzzy()
+    if self.phonetic_keys is None:
+      self._build_phonetic()
+
+    phrases = [fuzz_utils.full_process(heard, force_ascii=True)]
+    wordified = fuzz_utils.full_process(replaceDigits(heard), force_ascii=True)
+    if wordified != phrases[0]:
+      phrases.append(wordified)
+    phrases = [phrase for phrase in phrases if phrase]
+    if not phrases:
+      return None
+
+    candidates = self._phonetic_candidates(heard)
+    candidates.update(self._candidates(phrases))
+    candidates = sorted(candidates)
+    located = self._score(phrases, candidates)
+    if located is None and len(candidates) < len(self.results):
+      print 'Nothing on the shortlist matched, scoring every row...'
+      located = self._score(phrases, xrange(len(self.results)))
+    return located
+
+  def _score(self, phrases, candidates):
+    from fuzzywuzzy import fuzz
+
+    best = [(0, None)] * len(phrases)
+    for position in candidates:
+      name = self.processed[position]
+      if not name:
+        continue
+      for i, phrase in enumerate(phrases):
+        score = fuzz.QRatio(phrase, name, full_process=False)
+        if score > best[i][0]:
+          best[i] = (score, position)
+
+    for score, position in best:
+      if score > FUZZY_THRESHOLD:
+        print 'Fuzzy match %s%%' % (score)
+        return self.results[position]
+    return None
 
-  for result in results:
-    # Strip out non-ascii symbols and lowercase it
-    ascii_name = result[lookingFor].encode('ascii', 'replace')
-    result_name = str(ascii_name).lower().translate(None, string.punctuation)
 
-    # Direct comparison
-    if heard == result_name:
-      print 'Simple match on direct comparison'
-      located = result
-      break
+_match_indexes_lock = threading.Lock()
 
-    # Remove 'the'
-    if remove_the(result_name) == heard_minus_the:
-      print 'Simple match minus "the"'
-      located = result
-      break
 
-    # Remove parentheses
-    removed_paren = re.sub(r'\([^)]*\)', '', ascii_name).rstrip().lower().translate(None, string.punctuation)
-    if heard == removed_paren:
-      print 'Simple match minus parentheses'
-      located = result
-      break
+# Library mirror tables keep their indexes for as long as the mirror keeps
+# the table.  Any other list, e.g. one fetched for this request, gets a
+# fresh index that goes away with it.
+def GetMatchIndex(results, lookingFor='label'):
+  if isinstance(results, MatchIndex):
+    return results
+  if isinstance(results, SnapshotTable):
+    index = results.match_index(lookingFor)
+    if index is not None:
+      return index
+  if not isinstance(results, (list, RecordSequence)):
+    results = list(results)
+  if not isinstance(results, RecordSequence):
+    return MatchIndex(results, lookingFor)
+
+  with _match_indexes_lock:
+    index = results.indexes.get(lookingFor)
+  if index is None:
+    index = MatchIndex(results, lookingFor)
+    with _match_indexes_lock:
+      index = results.indexes.setdefault(lookingFor, index)
+  return index
+
+
+# Match heard string to something in the results
+def matchHeard(heard, results, lookingFor='label'):
+  print 'Trying to match: ' + heard
+  sys.stdout.flush()
+
+  index = GetMatchIndex(results, lookingFor)
+  located = index.simple_match(heard)
 
   if not located:
     print 'Simple match failed, trying fuzzy match...'
     sys.stdout.flush()
-    fuzzy_result = process.extract(str(heard), [d[lookingFor] for d in results], limit=1, scorer=fuzz.QRatio)
-    if fuzzy_result[0][1] > 75:
-      print 'Fuzzy match %s%%' % (fuzzy_result[0][1])
-      located = (item for item in results if item[lookingFor] == fuzzy_result[0][0]).next()
-    else:
-      heard = replaceDigits(heard)
-      fuzzy_result = process.extract(str(heard), [d[lookingFor] for d in results], limit=1, scorer=fuzz.QRatio)
-      if fuzzy_result[0][1] > 75:
-        print 'Fuzzy match %s%%' % (fuzzy_result[0][1])
-        located = (item for item in results if item[lookingFor] == fuzzy_result[0][0]).next()
+    located = index.fuzzy_match(heard)
 
   return located
 
@@ -277,6 +1412,43 @@ def FindAudioPlaylist(heard_search):
       return located['file']
 
 
+# Stop whatever is playing, replace the contents of a playlist with the given
+# items and start playing it, all in a single request to Kodi.  Returns the
+# response to Player.Open.
+def _ReplacePlaylist(playlistid, items):
+  batch = RPCBatch()
+  playerid = GetPlayerID()
+  if playerid is not None:
+    batch.add("Player.Stop", {"playerid": playerid})
+  batch.add("Playlist.Clear", {"playlistid": playlistid})
+  batch.add("Playlist.Add", {"playlistid": playlistid, "item": items})
+  batch.add("Player.Open", {"item": {"playlistid": playlistid}})
+  _player_state.invalidate()
+  return batch.send()[-1]
+
+
+# Stop whatever is playing and open a playlist file, in a single request.
+def _OpenPlaylistFile(playlist_file):
+  batch = RPCBatch()
+  playerid = GetPlayerID()
+  if playerid is not None:
+    batch.add("Player.Stop", {"playerid": playerid})
+  batch.add("Player.Open", {"item": {"file": playlist_file}})
+  _player_state.invalidate()
+  return batch.send()[-1]
+
+
+# Playlist items for a list of song ids, video files, etc., in the order
+# given or shuffled.  Used both to add to a playlist and to replace it.
+def _PlaylistItems(field, values, shuffle=False):
+  items = [{field: value} for value in values]
+
+  if shuffle:
+    random.shuffle(items)
+
+  return items
+
+
 def ClearAudioPlaylist():
   return SendCommand(RPCString("Playlist.Clear", {"playlistid": 0}))
 
@@ -286,17 +1458,7 @@ def AddSongToPlaylist(song_id):
 
 
 def AddSongsToPlaylist(song_ids, shuffle=False):
-  songs_array = []
-
-  for song_id in song_ids:
-    temp_song = {}
-    temp_song['songid'] = song_id
-    songs_array.append(temp_song)
-
-  if shuffle:
-    random.shuffle(songs_array)
-
-  return SendCommand(RPCString("Playlist.Add", {"playlistid": 0, "item": songs_array}))
+  return SendCommand(RPCString("Playlist.Add", {"playlistid": 0, "item": _PlaylistItems('songid', song_ids, shuffle)}))
 
 
 def AddAlbumToPlaylist(album_id):
@@ -308,12 +1470,29 @@ def GetAudioPlaylistItems():
 
 
 def StartAudioPlaylist(playlist_file=None):
+  _player_state.invalidate()
   if playlist_file is not None and playlist_file != '':
     return SendCommand(RPCString("Player.Open", {"item": {"file": playlist_file}}))
   else:
     return SendCommand(RPCString("Player.Open", {"item": {"playlistid": 0}}))
 
 
+def PlaySong(song_id):
+  return _ReplacePlaylist(0, {"songid": int(song_id)})
+
+
+def PlaySongs(song_ids, shuffle=False):
+  return _ReplacePlaylist(0, _PlaylistItems('songid', song_ids, shuffle))
+
+
+def PlayAlbum(album_id):
+  return _ReplacePlaylist(0, {"albumid": int(album_id)})
+
+
+def PlayAudioPlaylist(playlist_file):
+  return _OpenPlaylistFile(playlist_file)
+
+
 def FindVideoPlaylist(heard_search):
   print 'Searching for video playlist "%s"' % (heard_search)
 
@@ -341,17 +1520,7 @@ def AddMovieToPlaylist(movie_id):
 
 
 def AddVideosToPlaylist(video_files, shuffle=False):
-  videos_array = []
-
-  for video_file in video_files:
-    temp_video = {}
-    temp_video['file'] = video_file
-    videos_array.append(temp_video)
-
-  if shuffle:
-    random.shuffle(videos_array)
-
-  return SendCommand(RPCString("Playlist.Add", {"playlistid": 1, "item": videos_array}))
+  return SendCommand(RPCString("Playlist.Add", {"playlistid": 1, "item": _PlaylistItems('file', video_files, shuffle)}))
 
 
 def GetVideoPlaylistItems():
@@ -359,22 +1528,144 @@ def GetVideoPlaylistItems():
 
 
 def StartVideoPlaylist(playlist_file=None):
+  _player_state.invalidate()
   if playlist_file is not None and playlist_file != '':
     return SendCommand(RPCString("Player.Open", {"item": {"file": playlist_file}}))
   else:
     return SendCommand(RPCString("Player.Open", {"item": {"playlistid": 1}}))
 
 
+def PlayVideos(video_files, shuffle=False):
+  return _ReplacePlaylist(1, _PlaylistItems('file', video_files, shuffle))
+
+
+def PlayVideoPlaylist(playlist_file):
+  return _OpenPlaylistFile(playlist_file)
+
+
 # Direct plays
 
 def PlayEpisode(ep_id, resume=True):
+  _player_state.invalidate()
   return SendCommand(RPCString("Player.Open", {"item": {"episodeid": ep_id}, "options": {"resume": resume}}))
 
 
 def PlayMovie(movie_id, resume=True):
+  _player_state.invalidate()
   return SendCommand(RPCString("Player.Open", {"item": {"movieid": movie_id}, "options": {"resume": resume}}))
 
 
+# Background jobs
+#
+# Library scans and cleans can keep Kodi from answering for a long time, far
+# longer than Alexa waits for a response.  Commands like these are handed to
+# a small pool of threads instead, so the intent can answer straight away.
+# Asking for a job that is already waiting to run (two "clean the library"
+# in a row) gets the waiting job rather than a second one.
+
+BACKGROUND_WORKERS = 2
+BACKGROUND_QUEUE_SIZE = 32
+
+
+class BackgroundJob(object):
+  def __init__(self, key, function, args):
+    self.key = key
+    self.function = function
+    self.args = args
+    self.state = 'pending'
+    self.result = None
+    self.error = None
+    self.finished = threading.Event()
+
+  def wait(self, timeout=None):
+    self.finished.wait(timeout)
+    return self.finished.is_set()
+
+
+class BackgroundExecutor(object):
+  def __init__(self, workers=BACKGROUND_WORKERS, queue_size=BACKGROUND_QUEUE_SIZE):
+    self.workers = workers
+    self.queue = Queue.Queue(queue_size)
+    self.jobs = {}
+    self.threads = []
+    self.unfinished = 0
+    self.lock = threading.Condition()
+
+  def submit(self, key, function, *args):
+    with self.lock:
+      job = self.jobs.get(key)
+      if job is not None and job.state == 'pending':
+        return job
+      job = BackgroundJob(key, function, args)
+      try:
+        self.queue.put_nowait(job)
+      except Queue.Full:
+        print "Too many background jobs, dropping %s" % (key)
+        job.state, job.error = 'failed', 'queue full'
+        job.finished.set()
+        return job
+      self.jobs[key] = job
+      self.unfinished += 1
+      if len(self.threads) < min(self.workers, self.unfinished):
+        thread = threading.Thread(target=self._work)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+    return job
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+      with self.lock:
+        job.state = 'running'
+      try:
+        self._finish(job, 'done', result=job.function(*job.args))
+      except Exception as e:
+        print "Background job %s failed: %s" % (job.key, e)
+        self._finish(job, 'failed', error=e)
+
+  def _finish(self, job, state, result=None, error=None):
+    with self.lock:
+      job.state, job.result, job.error = state, result, error
+      self.unfinished -= 1
+      self.lock.notify_all()
+    job.finished.set()
+
+  # The latest job submitted under key, or None
+  def status(self, key):
+    with self.lock:
+      return self.jobs.get(key)
+
+  # Wait up to timeout seconds for every job to finish.  Returns whether
+  # they all did.
+  def drain(self, timeout):
+    deadline = time.time() + timeout
+    with self.lock:
+      while self.unfinished:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self.lock.wait(remaining)
+    return True
+
+
+_background = BackgroundExecutor()
+
+
+# Run function(*args) on a background thread.  Returns the BackgroundJob,
+# whose state goes from pending to running to done or failed.
+def RunInBackground(key, function, *args):
+  return _background.submit(key, function, *args)
+
+
+def GetBackgroundJob(key):
+  return _background.status(key)
+
+
+def DrainBackgroundJobs(timeout):
+  return _background.drain(timeout)
+
+
 # Tell Kodi to update its video or music libraries
 
 def UpdateVideo():
@@ -451,12 +1742,64 @@ def ToggleMute():
   return SendCommand(RPCString("Application.SetMute", {"mute":"toggle"}))
 
 
+# Keeps track of Kodi's volume so that changing it relative to where it is
+# takes one Application.SetVolume rather than asking first.  Kodi's answers
+# to SetVolume and GetProperties update it, and so do
+# Application.OnVolumeChanged notifications, which also catch changes made
+# with Kodi's own remote.  Like PlayerState, a volume we heard about over the
+# tcp or ws connection is trusted for as long as that connection stays up;
+# otherwise only for KODI_VOLUME_TTL seconds.
+class VolumeState(object):
+  def __init__(self):
+    self.volume = None
+    self.updated = 0
+    self.source = None
+    self.lock = threading.Lock()
+
+  def _connection(self):
+    transport = GetSocketTransport()
+    if transport is not None:
+      return transport.conn
+
+  # The volume, or None if we don't know it well enough
+  def get(self):
+    with self.lock:
+      if self.volume is None:
+        return None
+      if self.source is not None and self.source is self._connection():
+        return self.volume
+      if time.time() - self.updated < GetConfig().volume_ttl:
+        return self.volume
+      return None
+
+  def set(self, volume, source=None):
+    with self.lock:
+      self.volume = volume
+      self.updated = time.time()
+      self.source = source
+
+  def invalidate(self):
+    with self.lock:
+      self.volume = None
+
+  def on_notification(self, method, data):
+    if method == 'Application.OnVolumeChanged' and isinstance((data or {}).get('volume'), (int, float)):
+      self.set(int(round(data['volume'])), self._connection())
+
+
+_volume_state = VolumeState()
+AddNotificationListener(_volume_state.on_notification)
+
+
 def GetCurrentVolume():
-  return SendCommand(RPCString("Application.GetProperties", {"properties":["volume", "muted"]}))
+  data = SendCommand(RPCString("Application.GetProperties", {"properties":["volume", "muted"]}))
+  if 'result' in data:
+    _volume_state.set(data['result']['volume'])
+  return data
 
-def VolumeUp():
-  resp = GetCurrentVolume()
-  vol = resp['result']['volume']
+# The next multiple of 10 up or down from vol
+
+def _volume_step_up(vol):
   if vol % 10 == 0:
     # already modulo 10, so just add 10
     vol += 10
@@ -465,19 +1808,30 @@ def VolumeUp():
     vol -= vol % -10
   if vol > 100:
     vol = 100
-  return SendCommand(RPCString("Application.SetVolume", {"volume":vol}))
+  return vol
 
 
-def VolumeDown():
-  resp = GetCurrentVolume()
-  vol = resp['result']['volume']
+def _volume_step_down(vol):
   if vol % 10 != 0:
     # round up to nearest 10 first
     vol -= vol % -10
   vol -= 10
   if vol < 0:
     vol = 0
-  return SendCommand(RPCString("Application.SetVolume", {"volume":vol}))
+  return vol
+
+
+# These change the volume in the CommandQueue, so that several of them in a
+# row add up rather than racing each other.  It takes a single
+# Application.SetVolume when VolumeState knows the volume, which it always
+# does over a tcp or ws connection.
+
+def VolumeUp():
+  return QueueCommand(VolumeChange("volume up", _volume_step_up))
+
+
+def VolumeDown():
+  return QueueCommand(VolumeChange("volume down", _volume_step_down))
 
 
 def VolumeSet(vol, percent=True):
@@ -521,6 +1875,7 @@ def PlayStartOver():
 def Stop():
   playerid = GetPlayerID()
   if playerid is not None:
+    _player_state.invalidate()
     return SendCommand(RPCString("Player.Stop", {"playerid":playerid}))
 
 
@@ -656,10 +2011,992 @@ def AddonCinemaVision():
   return AddonExecute("script.cinemavision", ["experience"])
 
 
+# Local mirror of the Kodi library
+#
+# Looking something up by name means matching against the whole list of
+# movies, shows, songs, etc.  Rather than download those lists from Kodi for
+# every request, we keep a copy in memory and only go back to Kodi for what
+# changed:
+#
+# - Over a tcp or ws connection, Kodi's VideoLibrary/AudioLibrary OnUpdate
+#   and OnRemove notifications tell us exactly which items changed, and we
+#   refetch just those.
+# - Otherwise, at most every KODI_LIBRARY_TTL seconds we ask Kodi for the
+#   size of the collection and its newest dateadded, fetch anything added
+#   since, and fall back to a full refetch if items were removed.  Edits
+#   don't show up that way, so every KODI_LIBRARY_REFRESH seconds a
+#   background job fetches the whole collection again.
+#
+# Each collection's rows are replaced rather than modified in place, so a
+# list handed out by the mirror never changes under the caller.
+
+# Rows per request when paging through a library list
+LIBRARY_PAGE_SIZE = 1000
+
+
+# A library list query that asks for exactly the properties its caller
+# needs and fetches the rows a page at a time with limits.start/end, so a
+# big library never arrives as one huge response.  Walk the rows with
+# pages() or items(); rows() collects them, or returns None if Kodi
+# couldn't be asked.  total is filled in once the first page is back.
+# Iterating over the query is the same as items(); once that's done, failed
+# says whether Kodi's answer was missing or cut short.
+#
+# With stream=True the whole list is asked for in one request instead, and
+# its entries are decoded one by one as they arrive (see StreamCommand).
+# total is then only known once the last page has been handed out.
+class LibraryQuery(object):
+  def __init__(self, method, key, properties=None, params=None, limit=None, page_size=LIBRARY_PAGE_SIZE, stream=False):
+    self.method = method
+    self.key = key
+    self.properties = properties or []
+    self.params = params or {}
+    self.limit = limit
+    self.page_size = page_size
+    self.stream = stream
+    self.total = None
+    self.failed = False
+
+  def _streamed_pages(self):
+    query = dict(self.params)
+    if self.properties:
+      query['properties'] = self.properties
+    if self.limit is not None:
+      query['limits'] = {'start': 0, 'end': self.limit}
+
+    scanner = JSONArrayScanner(['result', self.key])
+    count = 0
+    page = []
+    for item in StreamCommand(RPCString(self.method, query), self.key, scanner):
+      page.append(item)
+      if len(page) == self.page_size:
+        count += len(page)
+        yield page
+        page = []
+    if page:
+      count += len(page)
+      yield page
+    self.failed = scanner.error or not scanner.done
+    self.total = count
+
+  def pages(self):
+    if self.stream:
+      for page in self._streamed_pages():
+        yield page
+      return
+
+    start = 0
+    while self.limit is None or start < self.limit:
+      end = start + self.page_size
+      if self.limit is not None:
+        end = min(end, self.limit)
+      query = dict(self.params)
+      if self.properties:
+        query['properties'] = self.properties
+      query['limits'] = {'start': start, 'end': end}
+
+      data = SendCommand(RPCString(self.method, query))
+      if 'result' not in data:
+        self.failed = True
+        return
+      result = data['result']
+      page = result.get(self.key, [])
+      self.total = result.get('limits', {}).get('total', start + len(page))
+      if page:
+        yield page
+      if len(page) < end - start:
+        return
+      start = end
+      if start >= self.total:
+        return
+
+  def items(self):
+    for page in self.pages():
+      for item in page:
+        yield item
+
+  def __iter__(self):
+    return self.items()
+
+  def rows(self):
+    rows = list(self.items())
+    if self.failed:
+      return None
+    return rows
+
+  def response(self):
+    rows = self.rows()
+    if rows is None:
+      return {}
+    return _LibraryResponse(self.key, rows)
+
+
+# Marks a missing value in a column of whole numbers
+_NO_NUMBER = -(2 ** 31)
+
+
+# What RecordTable and SnapshotTable have in common: a read-only list whose
+# entries are Records, looked up through value() and fields().  They're
+# always complete, so like a LibraryQuery that got everything, they haven't
+# failed.
+class RecordSequence(object):
+  length = 0
+  failed = False
+
+  def __len__(self):
+    return self.length
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(self.length))]
+    if index < 0:
+      index += self.length
+    if not 0 <= index < self.length:
+      raise IndexError('record index out of range')
+    return Record(self, index)
+
+  def __iter__(self):
+    for index in xrange(self.length):
+      yield Record(self, index)
+
+
+# A read-only list of library rows kept as columns instead of a dict per
+# row.  Whole number fields (ids, seasons, ...) are packed into arrays as
+# they are, and every other value is stored once in a table of distinct
+# values that the column points into, so repeated genres, dates and artist
+# lists cost nothing extra.  Indexing hands out a Record, which reads like
+# the dict Kodi sent.
+class RecordTable(RecordSequence):
+  def __init__(self, rows=()):
+    self.length = 0
+    self.indexes = {}
+    self.numbers = {}
+    self.pointers = {}
+    self.values = []
+    interned = {}
+
+    for row in rows:
+      for field, value in row.items():
+        if field in self.numbers:
+          if isinstance(value, (int, long)) and not isinstance(value, bool) and value != _NO_NUMBER:
+            self.numbers[field][self.length] = value
+            continue
+          # Not all whole numbers after all; keep this field as values
+          column = self.numbers.pop(field)
+          self.pointers[field] = array.array('l', [self._intern(interned, n) if n != _NO_NUMBER else -1 for n in column])
+        elif field not in self.pointers:
+          if isinstance(value, (int, long)) and not isinstance(value, bool) and value != _NO_NUMBER:
+            self.numbers[field] = array.array('l', [_NO_NUMBER] * (self.length + 1))
+            self.numbers[field][self.length] = value
+            continue
+          self.pointers[field] = array.array('l', [-1] * (self.length + 1))
+        self.pointers[field][self.length] = self._intern(interned, value)
+
+      self.length += 1
+      for column in self.numbers.values():
+        if len(column) < self.length + 1:
+          column.append(_NO_NUMBER)
+      for column in self.pointers.values():
+        if len(column) < self.length + 1:
+          column.append(-1)
+
+    # Every column carries one spare slot for the next row; drop it
+    for column in self.numbers.values() + self.pointers.values():
+      column.pop()
+
+  def _intern(self, interned, value):
+    if isinstance(value, list):
+      value = tuple(value)
+    try:
+      key = (type(value), value)
+      position = interned.get(key)
+    except TypeError:
+      # Nested objects can't be shared; keep them as they are
+      key = None
+      position = None
+    if position is None:
+      position = len(self.values)
+      self.values.append(value)
+      if key is not None:
+        interned[key] = position
+    return position
+
+  def fields(self, index):
+    fields = [field for field, column in self.numbers.items() if column[index] != _NO_NUMBER]
+    fields.extend([field for field, column in self.pointers.items() if column[index] != -1])
+    return fields
+
+  def value(self, index, field):
+    column = self.numbers.get(field)
+    if column is not None:
+      value = column[index]
+      if value == _NO_NUMBER:
+        raise KeyError(field)
+      return value
+    column = self.pointers.get(field)
+    if column is None or column[index] == -1:
+      raise KeyError(field)
+    value = self.values[column[index]]
+    if isinstance(value, tuple):
+      return list(value)
+    return value
+
+
+# One row of a RecordTable or SnapshotTable, looked up on demand
+class Record(object):
+  __slots__ = ('table', 'index')
+
+  def __init__(self, table, index):
+    self.table = table
+    self.index = index
+
+  def __getitem__(self, field):
+    return self.table.value(self.index, field)
+
+  def get(self, field, default=None):
+    try:
+      return self.table.value(self.index, field)
+    except KeyError:
+      return default
+
+  def __contains__(self, field):
+    return self.get(field, self) is not self
+
+  def keys(self):
+    return self.table.fields(self.index)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.keys())
+
+  def items(self):
+    return [(field, self[field]) for field in self.keys()]
+
+  def copy(self):
+    return dict(self.items())
+
+  def __eq__(self, other):
+    if isinstance(other, (Record, dict)):
+      return dict(self.items()) == dict(other.items())
+    return NotImplemented
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    if equal is NotImplemented:
+      return equal
+    return not equal
+
+  def __repr__(self):
+    return repr(self.copy())
+
+
+# Library snapshots
+#
+# A snapshot file holds one mirrored collection: its rows, laid out like a
+# RecordTable, plus a ready-made match index over them (normalized names,
+# fuzzy match trigrams and phonetic postings).  Everything is stored so it
+# can be used straight from an mmap, so all the worker processes on a
+# machine share one copy of it in the page cache, and a worker that starts
+# up can match against the library without asking Kodi for all of it.
+#
+# A file starts with SNAPSHOT_MAGIC and the length of a JSON header that
+# describes the collection and where each section lives, counting from the
+# first 8-byte boundary after the header.  Sections are arrays of native
+# machine words.  Names are looked up by a 64-bit hash
+# of their UTF-8 text in tables sorted by hash, each entry pointing at a
+# run of row positions.  Snapshots are written to a temporary file and
+# renamed into place, so readers only ever see a complete one.
+
+SNAPSHOT_MAGIC = 'KODISNP2'
+_SNAPSHOT_PREAMBLE = struct.Struct('=8sI')
+_SNAPSHOT_KEY = struct.Struct('=QII')
+# Whole number columns are stored as RecordTable keeps them
+_SNAPSHOT_NUMBER = struct.Struct('l')
+
+
+def _snapshot_hash(name):
+  if isinstance(name, unicode):
+    name = name.encode('utf-8')
+  return struct.unpack('=Q', hashlib.md5(name).digest()[:8])[0]
+
+
+def _aligned(length):
+  return (length + 7) & ~7
+
+
+# A table of names, by hash, each pointing at a run of row positions
+class SnapshotPostings(object):
+  def __init__(self, buf, keys_offset, count, positions_offset):
+    self.buf = buf
+    self.keys_offset = keys_offset
+    self.count = count
+    self.positions_offset = positions_offset
+
+  def _find(self, name):
+    wanted = _snapshot_hash(name)
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      found, start, count = _SNAPSHOT_KEY.unpack_from(self.buf, self.keys_offset + mid * _SNAPSHOT_KEY.size)
+      if found < wanted:
+        lo = mid + 1
+      elif found > wanted:
+        hi = mid
+      else:
+        return start, count
+    return None
+
+  def get(self, name, default=None):
+    found = self._find(name)
+    if found is None:
+      return default
+    start, count = found
+    return struct.unpack_from('=%dI' % count, self.buf, self.positions_offset + start * 4)
+
+  def __contains__(self, name):
+    return self._find(name) is not None
+
+  def __getitem__(self, name):
+    positions = self.get(name)
+    if positions is None:
+      raise KeyError(name)
+    return positions
+
+
+# The same, for names that point at exactly one row
+class SnapshotPositions(SnapshotPostings):
+  def get(self, name, default=None):
+    positions = SnapshotPostings.get(self, name)
+    if positions is None:
+      return default
+    return positions[0]
+
+
+# A list of strings stored as offsets into one block of UTF-8 text
+class SnapshotStrings(object):
+  def __init__(self, buf, offsets_offset, count, text_offset):
+    self.buf = buf
+    self.offsets_offset = offsets_offset
+    self.count = count
+    self.text_offset = text_offset
+
+  def raw(self, index):
+    start, end = struct.unpack_from('=II', self.buf, self.offsets_offset + index * 4)
+    return self.buf[self.text_offset + start:self.text_offset + end]
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    return self.raw(index)
+
+
+# A list of whole numbers stored as an array
+class SnapshotCounts(object):
+  def __init__(self, buf, offset, count):
+    self.buf = buf
+    self.offset = offset
+    self.count = count
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    return struct.unpack_from('=I', self.buf, self.offset + index * 4)[0]
+
+
+# A MatchIndex whose tables live in a snapshot rather than in dicts
+class SnapshotMatchIndex(MatchIndex):
+  def __init__(self, table, lookingFor, sections):
+    self.results = table
+    self.lookingFor = lookingFor
+    self.exact = table.positions(sections['exact'])
+    self.minus_the = table.positions(sections['minus_the'])
+    self.minus_paren = table.positions(sections['minus_paren'])
+    self.processed = table.strings(sections['processed'])
+    self.gram_counts = table.counts(sections['gram_counts'])
+    self.postings = table.postings(sections['trigrams'])
+    self.phonetic_keys = table.postings(sections['phonetic_keys'])
+    self.phonetic_postings = table.postings(sections['phonetic_words'])
+
+
+# The rows of a snapshot file, read straight from an mmap of it.  Use
+# OpenSnapshot rather than creating these directly.
+class SnapshotTable(RecordSequence):
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_length = _SNAPSHOT_PREAMBLE.unpack_from(self.buf, 0)
+    if magic != SNAPSHOT_MAGIC:
+      raise ValueError('%s is not a library snapshot' % path)
+    self.header = json.loads(self.buf[_SNAPSHOT_PREAMBLE.size:_SNAPSHOT_PREAMBLE.size + header_length])
+    if self.header['byteorder'] != sys.byteorder or self.header['number_size'] != _SNAPSHOT_NUMBER.size:
+      raise ValueError('%s was written on a different kind of machine' % path)
+    self.base = _aligned(_SNAPSHOT_PREAMBLE.size + header_length)
+    self.path = path
+    self.length = self.header['length']
+    self.numbers = dict([(field, self.base + offset) for field, offset in self.header['numbers'].items()])
+    self.pointers = dict([(field, self.base + offset) for field, offset in self.header['pointers'].items()])
+    self.values = self.strings(self.header['values'])
+    self.indexes = {}
+
+  # Sections are [offset, count, offset]
+  def _section(self, section):
+    return self.base + section[0], section[1], self.base + section[2]
+
+  def positions(self, section):
+    return SnapshotPositions(self.buf, *self._section(section))
+
+  # Count sections are [offset, count]
+  def counts(self, section):
+    return SnapshotCounts(self.buf, self.base + section[0], section[1])
+
+  def postings(self, section):
+    return SnapshotPostings(self.buf, *self._section(section))
+
+  def strings(self, section):
+    return SnapshotStrings(self.buf, *self._section(section))
+
+  def fields(self, index):
+    fields = [field for field, offset in self.numbers.items() if _SNAPSHOT_NUMBER.unpack_from(self.buf, offset + index * _SNAPSHOT_NUMBER.size)[0] != _NO_NUMBER]
+    fields.extend([field for field, offset in self.pointers.items() if struct.unpack_from('=i', self.buf, offset + index * 4)[0] != -1])
+    return fields
+
+  def value(self, index, field):
+    offset = self.numbers.get(field)
+    if offset is not None:
+      value = _SNAPSHOT_NUMBER.unpack_from(self.buf, offset + index * _SNAPSHOT_NUMBER.size)[0]
+      if value == _NO_NUMBER:
+        raise KeyError(field)
+      return value
+    offset = self.pointers.get(field)
+    if offset is None:
+      raise KeyError(field)
+    pointer = struct.unpack_from('=i', self.buf, offset + index * 4)[0]
+    if pointer == -1:
+      raise KeyError(field)
+    return json.loads(self.values.raw(pointer))
+
+  # The snapshot's own match index for a field, if it has one
+  def match_index(self, lookingFor):
+    sections = self.header['indexes'].get(lookingFor)
+    if sections is None:
+      return None
+    index = self.indexes.get(lookingFor)
+    if index is None:
+      index = self.indexes[lookingFor] = SnapshotMatchIndex(self, lookingFor, sections)
+    return index
+
+
+class _SnapshotWriter(object):
+  def __init__(self):
+    self.chunks = []
+    self.length = 0
+
+  def add(self, data):
+    offset = self.length
+    padding = _aligned(len(data)) - len(data)
+    self.chunks.append(data + '\0' * padding)
+    self.length += len(data) + padding
+    return offset
+
+  def strings(self, strings):
+    offsets = array.array('I', [0])
+    encoded = []
+    for text in strings:
+      if isinstance(text, unicode):
+        text = text.encode('utf-8')
+      encoded.append(text)
+      offsets.append(offsets[-1] + len(text))
+    return [self.add(offsets.tostring()), len(strings), self.add(''.join(encoded))]
+
+  # mapping is name -> position, or name -> positions
+  def postings(self, mapping):
+    by_hash = {}
+    for name, positions in mapping.items():
+      if isinstance(positions, (int, long)):
+        positions = [positions]
+      # Two names with the same hash would need astronomical luck; if it
+      # happens they simply share their positions
+      by_hash.setdefault(_snapshot_hash(name), []).extend(positions)
+
+    keys = []
+    positions = array.array('I')
+    for key in sorted(by_hash):
+      keys.append(_SNAPSHOT_KEY.pack(key, len(positions), len(by_hash[key])))
+      positions.extend(by_hash[key])
+    return [self.add(''.join(keys)), len(keys), self.add(positions.tostring())]
+
+
+# Writes rows (any list of row dicts or Records) and match indexes for the
+# given fields to path.  info is stored in the header for the reader.
+def WriteSnapshot(path, rows, lookingFor=('label',), info=None):
+  if not isinstance(rows, RecordTable):
+    rows = RecordTable(rows)
+
+  writer = _SnapshotWriter()
+  header = dict(info or {})
+  header['byteorder'] = sys.byteorder
+  header['number_size'] = _SNAPSHOT_NUMBER.size
+  header['length'] = len(rows)
+  header['numbers'] = {}
+  header['pointers'] = {}
+  for field, column in rows.numbers.items():
+    header['numbers'][field] = writer.add(column.tostring())
+  for field, column in rows.pointers.items():
+    header['pointers'][field] = writer.add(array.array('i', column).tostring())
+  header['values'] = writer.strings([json.dumps(value) for value in rows.values])
+
+  header['indexes'] = {}
+  for field in lookingFor:
+    if not all(field in row for row in rows):
+      continue
+    index = MatchIndex(rows, field)
+    index._build_fuzzy()
+    index._build_phonetic()
+    header['indexes'][field] = {
+      'exact': writer.postings(index.exact),
+      'minus_the': writer.postings(index.minus_the),
+      'minus_paren': writer.postings(index.minus_paren),
+      'processed': writer.strings(index.processed),
+      'gram_counts': [writer.add(index.gram_counts.tostring()), len(index.gram_counts)],
+      'trigrams': writer.postings(index.postings),
+      'phonetic_keys': writer.postings(index.phonetic_keys),
+      'phonetic_words': writer.postings(index.phonetic_postings),
+    }
+
+  text = json.dumps(header)
+  preamble = _SNAPSHOT_PREAMBLE.pack(SNAPSHOT_MAGIC, len(text)) + text
+  preamble += '\0' * (_aligned(len(preamble)) - len(preamble))
+
+  temporary = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+  try:
+    with open(temporary, 'wb') as f:
+      f.write(preamble)
+      for chunk in writer.chunks:
+        f.write(chunk)
+    os.rename(temporary, path)
+  except Exception:
+    if os.path.exists(temporary):
+      os.remove(temporary)
+    raise
+
+
+# Opens a snapshot, or returns None if there isn't a usable one at path
+def OpenSnapshot(path):
+  if not os.path.exists(path):
+    return None
+  try:
+    return SnapshotTable(path)
+  except Exception as e:
+    print "Ignoring library snapshot %s: %s" % (path, e)
+    return None
+
+
+LibraryCollection = collections.namedtuple('LibraryCollection', [
+  'method',
+  'params',
+  'key',
+  'idfield',
+  'properties',
+  'details_method',
+  'details_key',
+])
+
+LIBRARY_COLLECTIONS = {
+  'movies': LibraryCollection('VideoLibrary.GetMovies', {}, 'movies', 'movieid', ['genre', 'dateadded'], 'VideoLibrary.GetMovieDetails', 'moviedetails'),
+  'tvshows': LibraryCollection('VideoLibrary.GetTVShows', {}, 'tvshows', 'tvshowid', ['dateadded'], 'VideoLibrary.GetTVShowDetails', 'tvshowdetails'),
+  'episodes': LibraryCollection('VideoLibrary.GetEpisodes', {}, 'episodes', 'episodeid', ['tvshowid', 'season', 'episode', 'dateadded'], 'VideoLibrary.GetEpisodeDetails', 'episodedetails'),
+  'moviegenres': LibraryCollection('VideoLibrary.GetGenres', {'type': 'movie'}, 'genres', 'genreid', [], None, None),
+  'videoplaylists': LibraryCollection('Files.GetDirectory', {'directory': 'special://videoplaylists'}, 'files', 'file', [], None, None),
+  'artists': LibraryCollection('AudioLibrary.GetArtists', {}, 'artists', 'artistid', [], 'AudioLibrary.GetArtistDetails', 'artistdetails'),
+  'albums': LibraryCollection('AudioLibrary.GetAlbums', {}, 'albums', 'albumid', ['artistid', 'dateadded'], 'AudioLibrary.GetAlbumDetails', 'albumdetails'),
+  'songs': LibraryCollection('AudioLibrary.GetSongs', {}, 'songs', 'songid', ['artistid', 'dateadded'], 'AudioLibrary.GetSongDetails', 'songdetails'),
+  'musicgenres': LibraryCollection('AudioLibrary.GetGenres', {}, 'genres', 'genreid', [], None, None),
+  'musicplaylists': LibraryCollection('Files.GetDirectory', {'directory': 'special://musicplaylists'}, 'files', 'file', [], None, None),
+  'videoaddons': LibraryCollection('Addons.GetAddons', {'content': 'video'}, 'addons', 'addonid', ['name'], None, None),
+  'audioaddons': LibraryCollection('Addons.GetAddons', {'content': 'audio'}, 'addons', 'addonid', ['name'], None, None),
+  'imageaddons': LibraryCollection('Addons.GetAddons', {'content': 'image'}, 'addons', 'addonid', ['name'], None, None),
+  'executableaddons': LibraryCollection('Addons.GetAddons', {'content': 'executable'}, 'addons', 'addonid', ['name'], None, None),
+}
+
+# Which collection a library notification's item type belongs to
+LIBRARY_ITEM_TYPES = {
+  'movie': 'movies',
+  'tvshow': 'tvshows',
+  'episode': 'episodes',
+  'artist': 'artists',
+  'album': 'albums',
+  'song': 'songs',
+}
+
+# Which collections a scan or clean of each library can change
+LIBRARY_GROUPS = {
+  'VideoLibrary': ['movies', 'tvshows', 'episodes', 'moviegenres', 'videoplaylists'],
+  'AudioLibrary': ['artists', 'albums', 'songs', 'musicgenres', 'musicplaylists'],
+}
+
+# The big collections, which the mirror keeps as RecordTables
+LIBRARY_COMPACT = set(['movies', 'episodes', 'artists', 'albums', 'songs'])
+
+# Snapshots shipped alongside this file, e.g. by deploy-to-lambda.py, so
+# even a cold container can start without fetching the library.  They're
+# only used when KODI_SNAPSHOT_DIR has nothing newer.
+SNAPSHOT_BUNDLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots')
+
+# The fields each compact collection's snapshot has a match index for
+LIBRARY_MATCHED_FIELDS = {
+  'movies': ['label'],
+  'episodes': [],
+  'artists': ['artist'],
+  'albums': ['label'],
+  'songs': ['label'],
+}
+
+# Refetching single items is only worth it for a handful of changes
+LIBRARY_MAX_ITEM_UPDATES = 50
+
+
+class MirroredCollection(object):
+  def __init__(self, name):
+    self.name = name
+    self.definition = LIBRARY_COLLECTIONS[name]
+    self.rows = None
+    self.total = None
+    self.newest = None
+    self.checked = 0
+    self.fetched = 0
+    self.source = None
+    self.updates = set()
+    self.removals = set()
+    self.lock = threading.Lock()
+
+  def _query(self, params=None, limit=None):
+    definition = self.definition
+    query = dict(definition.params)
+    if params:
+      query.update(params)
+    query = LibraryQuery(definition.method, definition.key, definition.properties, query, limit)
+    rows = self._store(query.items())
+    if query.failed:
+      return None, None
+    return rows, query.total
+
+  def _store(self, rows):
+    if self.name in LIBRARY_COMPACT:
+      if isinstance(rows, RecordTable):
+        return rows
+      return RecordTable(rows)
+    return list(rows)
+
+  # The cheapest question that tells us whether the collection changed:
+  # how big is it, and when was the newest item added?
+  def _marker(self):
+    params = {}
+    if 'dateadded' in self.definition.properties:
+      params['sort'] = {'method': 'dateadded', 'order': 'descending'}
+    rows, total = self._query(params, limit=1)
+    if rows is None:
+      return None, None
+    newest = rows[0].get('dateadded') if rows else None
+    return total, newest
+
+  def _newest(self, rows):
+    if 'dateadded' not in self.definition.properties or not rows:
+      return None
+    return max([row.get('dateadded', '') for row in rows])
+
+  # Writing a snapshot (and its match indexes) of a big library takes
+  # seconds, so that's left to a background job and this request is served
+  # from the rows in memory.  Changes that come in while the job is waiting
+  # to run are written by that same job.
+  def _replace(self, rows, total, source, snapshot=True):
+    rows = self._store(rows)
+    self.rows = rows
+    self.total = total if total is not None else len(rows)
+    self.newest = self._newest(rows)
+    self.checked = time.time()
+    self.source = source
+    print 'Mirrored %d %s' % (len(rows), self.name)
+    if snapshot and self._snapshot_path() is not None:
+      RunInBackground(self._snapshot_job(), self._save_snapshot)
+
+  def _snapshot_job(self):
+    return 'snapshot-%s' % (self.name)
+
+  def _snapshot_name(self):
+    if self.name not in LIBRARY_COMPACT:
+      return None
+    # Keep snapshots of different Kodi installs apart
+    host = hashlib.md5(GetConfig().url).hexdigest()[:8]
+    return 'kodi-%s-%s.snapshot' % (self.name, host)
+
+  # Where this worker writes its snapshot, if anywhere
+  def _snapshot_path(self):
+    name = self._snapshot_name()
+    if name is None or not GetConfig().snapshot_dir:
+      return None
+    return os.path.join(GetConfig().snapshot_dir, name)
+
+  # The snapshots there are to read: the shared one, then the bundled one
+  def _snapshot_paths(self):
+    name = self._snapshot_name()
+    if name is None:
+      return []
+    paths = [path for path in (self._snapshot_path(), os.path.join(SNAPSHOT_BUNDLE_DIR, name)) if path]
+    return [path for path in paths if os.path.exists(path)]
+
+  # Share what we fetched with the other workers, and serve it from the
+  # shared copy ourselves unless it has changed again in the meantime.
+  def _save_snapshot(self):
+    path = self._snapshot_path()
+    with self.lock:
+      rows, total, newest = self.rows, self.total, self.newest
+    if path is None or rows is None or isinstance(rows, SnapshotTable):
+      return
+    try:
+      WriteSnapshot(path, rows, LIBRARY_MATCHED_FIELDS[self.name], {'name': self.name, 'total': total, 'newest': newest})
+    except (IOError, OSError) as e:
+      print "Could not write library snapshot %s: %s" % (path, e)
+      return
+    snapshot = OpenSnapshot(path)
+    with self.lock:
+      if snapshot is not None and self.rows is rows:
+        self.rows = snapshot
+
+  # Serve the snapshot another worker wrote (or the one bundled with the
+  # code), if it's of the collection as Kodi has it now.  With no marker,
+  # any snapshot will do for a start.
+  def _load_snapshot(self, total, newest, source):
+    for path in self._snapshot_paths():
+      snapshot = OpenSnapshot(path)
+      if snapshot is None:
+        continue
+      header = snapshot.header
+      if total is None or (header['total'], header['newest']) == (total, newest):
+        break
+    else:
+      return False
+    self.rows = snapshot
+    self.total = header['total']
+    self.newest = header['newest']
+    self.checked = time.time() if total is not None else 0
+    self.fetched = time.time()
+    self.source = source if total is not None else None
+    print 'Loaded %d %s from %s' % (len(snapshot), self.name, path)
+    return True
+
+  # Only ever reads snapshots.  They're written by the job _replace starts,
+  # and only with KODI_SNAPSHOT_DIR set, so on Lambda a cold container just
+  # uses the bundled one if it still matches.
+  def _load(self, source):
+    if self._snapshot_paths():
+      total, newest = self._marker()
+      if self._load_snapshot(total, newest, source):
+        return
+    self._refetch(source)
+
+  def _refetch(self, source):
+    with _library_mirror.lock:
+      self.updates.clear()
+      self.removals.clear()
+    rows, total = self._query()
+    if rows is not None:
+      self._replace(rows, total, source)
+      self.fetched = time.time()
+
+  # Runs as a background job, so the collection isn't locked while Kodi
+  # sends it.  Identical rows are kept, along with their indexes and
+  # snapshot.
+  def _refresh(self):
+    started = time.time()
+    source = _library_mirror.connection()
+    rows, total = self._query()
+    if rows is None:
+      return
+    with self.lock:
+      if self.fetched >= started or self.rows is None:
+        return
+      if len(rows) != len(self.rows) or any(row != old_row for row, old_row in itertools.izip(rows, self.rows)):
+        self._replace(rows, total, source)
+      self.fetched = time.time()
+
+  def _check_for_changes(self, source):
+    total, newest = self._marker()
+    if total is None:
+      # Couldn't reach Kodi; keep serving what we have
+      return
+    if total == self.total and newest == self.newest:
+      self.checked = time.time()
+      self.source = source
+      return
+    if self._load_snapshot(total, newest, source):
+      return
+    if self.newest and newest and newest > self.newest:
+      added, _ = self._query({'filter': {'field': 'dateadded', 'operator': 'after', 'value': self.newest}})
+      if added is not None:
+        # Kodi may compare by day, so skip anything we already have
+        idfield = self.definition.idfield
+        known = set([row.get(idfield) for row in self.rows])
+        added = [row for row in added if row.get(idfield) not in known]
+      if added is not None and self.total + len(added) == total:
+        self._replace(itertools.chain(self.rows, added), total, source)
+        return
+    self._refetch(source)
+
+  def _apply_item_changes(self, source):
+    with _library_mirror.lock:
+      updates, self.updates = self.updates, set()
+      removals, self.removals = self.removals, set()
+
+    definition = self.definition
+    if len(updates) > LIBRARY_MAX_ITEM_UPDATES or (updates and not definition.details_method):
+      self._refetch(source)
+      return
+
+    changed = {}
+    if updates:
+      batch = RPCBatch()
+      ordered_updates = list(updates)
+      for item_id in ordered_updates:
+        batch.add(definition.details_method, {definition.idfield: item_id, 'properties': definition.properties})
+      for item_id, response in zip(ordered_updates, batch.send()):
+        if 'result' in response and definition.details_key in response['result']:
+          changed[item_id] = response['result'][definition.details_key]
+        elif 'error' in response:
+          removals.add(item_id)
+        else:
+          # No answer from Kodi; try again next time
+          with _library_mirror.lock:
+            self.updates.add(item_id)
+
+    rows = []
+    for row in self.rows:
+      item_id = row.get(definition.idfield)
+      if item_id in removals:
+        continue
+      rows.append(changed.pop(item_id, row))
+    rows.extend(changed.values())
+    # Not worth rewriting the snapshot for, e.g., a song's play count.  Other
+    # workers get the same notifications, and a snapshot that's missing
+    # items no longer matches Kodi's total, so it won't be loaded.
+    self._replace(rows, len(rows), source, snapshot=False)
+
+  def get(self):
+    with self.lock:
+      connection = _library_mirror.connection()
+      if self.rows is None:
+        self._load(connection)
+      elif self.updates or self.removals:
+        self._apply_item_changes(connection)
+      elif self.source is None or self.source is not connection:
+        if time.time() - self.checked >= GetConfig().library_ttl:
+          self._check_for_changes(connection)
+      if self.rows is not None and (self.source is None or self.source is not connection):
+        if time.time() - self.fetched >= GetConfig().library_refresh:
+          RunInBackground('refresh-%s' % (self.name), self._refresh)
+      return self.rows
+
+  def stale(self):
+    self.source = None
+    self.checked = 0
+
+
+class LibraryMirror(object):
+  def __init__(self):
+    self.collections = dict([(name, MirroredCollection(name)) for name in LIBRARY_COLLECTIONS])
+    self.lock = threading.Lock()
+
+  def connection(self):
+    transport = GetSocketTransport()
+    if transport is not None:
+      return transport.conn
+
+  def rows(self, name, loaded_only=False):
+    collection = self.collections[name]
+    if loaded_only and collection.rows is None:
+      return None
+    return collection.get()
+
+  def on_notification(self, method, data):
+    library, _, event = method.partition('.')
+    if library not in ('VideoLibrary', 'AudioLibrary'):
+      return
+
+    data = data or {}
+    item = data.get('item', data)
+    name = LIBRARY_ITEM_TYPES.get(item.get('type'))
+    if event in ('OnUpdate', 'OnRemove') and name and 'id' in item:
+      collection = self.collections[name]
+      with self.lock:
+        if event == 'OnUpdate':
+          collection.updates.add(item['id'])
+        else:
+          collection.removals.add(item['id'])
+          collection.updates.discard(item['id'])
+    elif event in ('OnScanFinished', 'OnCleanFinished'):
+      # After a scan or clean, check every collection of that library
+      for name in LIBRARY_GROUPS[library]:
+        self.collections[name].stale()
+
+
+_library_mirror = LibraryMirror()
+AddNotificationListener(_library_mirror.on_notification)
+
+
+# Fetch every collection that snapshots are kept of, so that they're all
+# written out to KODI_SNAPSHOT_DIR.  Returns the names of the ones written.
+def SaveLibrarySnapshots():
+  saved = []
+  for name in sorted(LIBRARY_COMPACT):
+    collection = _library_mirror.collections[name]
+    if collection.get() is None:
+      continue
+    job = GetBackgroundJob(collection._snapshot_job())
+    if job is not None:
+      job.wait()
+    if isinstance(collection.rows, SnapshotTable):
+      saved.append(name)
+  return saved
+
+
+# Returns the mirrored rows of a library collection, or None if the mirror is
+# turned off (KODI_LIBRARY_MIRROR=false) or Kodi couldn't be reached.
+def GetLibraryRows(name):
+  if not GetConfig().library_mirror:
+    return None
+  return _library_mirror.rows(name)
+
+
+# The same, but only if this process already has the collection.  For
+# lookups of a few items (one artist's songs, one show's episodes), where
+# fetching the whole collection first would be far slower than asking Kodi
+# for just those.
+def GetLoadedLibraryRows(name):
+  if not GetConfig().library_mirror:
+    return None
+  return _library_mirror.rows(name, loaded_only=True)
+
+
+# Wrap mirrored rows up the way Kodi would have answered the query.  Note
+# that Kodi leaves out the list entirely when there are no results.
+def _LibraryResponse(key, rows):
+  result = {'limits': {'start': 0, 'end': len(rows), 'total': len(rows)}}
+  if rows:
+    result[key] = rows
+  return {'result': result}
+
+
 # Library queries
 
 # content can be: video, audio, image, executable, or unknown
 def GetAddons(content):
+  if content in ('video', 'audio', 'image', 'executable'):
+    rows = GetLibraryRows(content + 'addons')
+    if rows is not None:
+      return _LibraryResponse('addons', rows)
   if content:
     return SendCommand(RPCString("Addons.GetAddons", {"content":content, "properties":["name"]}))
   else:
@@ -675,35 +3012,63 @@ def GetPlaylistItems(playlist_file):
 
 
 def GetMusicPlaylists():
+  rows = GetLibraryRows('musicplaylists')
+  if rows is not None:
+    return _LibraryResponse('files', rows)
   return SendCommand(RPCString("Files.GetDirectory", {"directory": "special://musicplaylists"}))
 
 
 def GetMusicArtists():
-  return SendCommand(RPCString("AudioLibrary.GetArtists"))
+  rows = GetLibraryRows('artists')
+  if rows is not None:
+    return _LibraryResponse('artists', rows)
+  return LibraryQuery("AudioLibrary.GetArtists", 'artists').response()
 
 
 def GetMusicGenres():
+  rows = GetLibraryRows('musicgenres')
+  if rows is not None:
+    return _LibraryResponse('genres', rows)
   return SendCommand(RPCString("AudioLibrary.GetGenres"))
 
 
 def GetArtistAlbums(artist_id):
+  rows = GetLoadedLibraryRows('albums')
+  if rows is not None:
+    return _LibraryResponse('albums', [x for x in rows if int(artist_id) in x.get('artistid', [])])
   return SendCommand(RPCString("AudioLibrary.GetAlbums", {"filter": {"artistid": int(artist_id)}}))
 
 
 def GetAlbums():
-  return SendCommand(RPCString("AudioLibrary.GetAlbums"))
+  rows = GetLibraryRows('albums')
+  if rows is not None:
+    return _LibraryResponse('albums', rows)
+  return LibraryQuery("AudioLibrary.GetAlbums", 'albums').response()
 
 
 def GetArtistSongs(artist_id):
+  rows = GetLoadedLibraryRows('songs')
+  if rows is not None:
+    return _LibraryResponse('songs', [x for x in rows if int(artist_id) in x.get('artistid', [])])
   return SendCommand(RPCString("AudioLibrary.GetSongs", {"filter": {"artistid": int(artist_id)}}))
 
 
 def GetSongs():
-  return SendCommand(RPCString("AudioLibrary.GetSongs"))
+  rows = GetLibraryRows('songs')
+  if rows is not None:
+    return _LibraryResponse('songs', rows)
+  return LibraryQuery("AudioLibrary.GetSongs", 'songs').response()
 
 
-def GetArtistSongs(artist_id):
-  return SendCommand(RPCString("AudioLibrary.GetSongs", {"filter": {"artistid": int(artist_id)}}))
+# Every song in the library, for callers that only walk through them once.
+# Without the mirror the songs are streamed off Kodi's response as they're
+# used, instead of all being decoded up front.  Check failed once done to
+# tell whether that response was cut short.
+def IterSongs():
+  rows = GetLibraryRows('songs')
+  if rows is not None:
+    return rows
+  return LibraryQuery("AudioLibrary.GetSongs", 'songs', stream=True)
 
 
 def GetRecentlyAddedAlbums():
@@ -715,6 +3080,9 @@ def GetRecentlyAddedSongs():
 
 
 def GetVideoPlaylists():
+  rows = GetLibraryRows('videoplaylists')
+  if rows is not None:
+    return _LibraryResponse('files', rows)
   return SendCommand(RPCString("Files.GetDirectory", {"directory": "special://videoplaylists"}))
 
 
@@ -724,7 +3092,10 @@ def GetTvShowDetails(show_id):
 
 
 def GetTvShows():
-  return SendCommand(RPCString("VideoLibrary.GetTVShows"))
+  rows = GetLibraryRows('tvshows')
+  if rows is not None:
+    return _LibraryResponse('tvshows', rows)
+  return LibraryQuery("VideoLibrary.GetTVShows", 'tvshows').response()
 
 
 def GetMovieDetails(movie_id):
@@ -733,14 +3104,24 @@ def GetMovieDetails(movie_id):
 
 
 def GetMovies():
-  return SendCommand(RPCString("VideoLibrary.GetMovies"))
+  rows = GetLibraryRows('movies')
+  if rows is not None:
+    return _LibraryResponse('movies', rows)
+  return LibraryQuery("VideoLibrary.GetMovies", 'movies').response()
 
 
 def GetMoviesByGenre(genre):
+  rows = GetLoadedLibraryRows('movies')
+  if rows is not None:
+    genre = genre.lower()
+    return _LibraryResponse('movies', [x for x in rows if genre in [g.lower() for g in x.get('genre', [])]])
   return SendCommand(RPCString("VideoLibrary.GetMovies", {"filter":{"genre":genre}}))
 
 
 def GetMovieGenres():
+  rows = GetLibraryRows('moviegenres')
+  if rows is not None:
+    return _LibraryResponse('genres', rows)
   return SendCommand(RPCString("VideoLibrary.GetGenres", {"type": "movie"}))
 
 
@@ -750,6 +3131,9 @@ def GetEpisodeDetails(ep_id):
 
 
 def GetEpisodesFromShow(show_id):
+  rows = GetLoadedLibraryRows('episodes')
+  if rows is not None:
+    return _LibraryResponse('episodes', [x for x in rows if x.get('tvshowid') == int(show_id)])
   return SendCommand(RPCString("VideoLibrary.GetEpisodes", {"tvshowid": int(show_id)}))
 
 
@@ -796,7 +3180,11 @@ def GetLastWatchedShow():
 
 
 def GetSpecificEpisode(show_id, season, episode):
-  data = SendCommand(RPCString("VideoLibrary.GetEpisodes", {"tvshowid": int(show_id), "season": int(season), "properties": ["season", "episode"]}))
+  rows = GetLoadedLibraryRows('episodes')
+  if rows is not None:
+    data = _LibraryResponse('episodes', [x for x in rows if x.get('tvshowid') == int(show_id) and x.get('season') == int(season)])
+  else:
+    data = SendCommand(RPCString("VideoLibrary.GetEpisodes", {"tvshowid": int(show_id), "season": int(season), "properties": ["season", "episode"]}))
   if 'episodes' in data['result']:
     correct_id = None
     for episode_data in data['result']['episodes']:
@@ -810,6 +3198,9 @@ def GetSpecificEpisode(show_id, season, episode):
 
 
 def GetEpisodesFromShowDetails(show_id):
+  rows = GetLoadedLibraryRows('episodes')
+  if rows is not None:
+    return _LibraryResponse('episodes', [x for x in rows if x.get('tvshowid') == int(show_id)])
   return SendCommand(RPCString("VideoLibrary.GetEpisodes", {"tvshowid": int(show_id), "properties": ["season", "episode"]}))
 
 
@@ -846,12 +3237,7 @@ def GetUnwatchedMoviesByGenre(genre, max=90):
 def GetUnwatchedEpisodes(max=90):
   data = SendCommand(RPCString("VideoLibrary.GetEpisodes", {"limits":{"end":max}, "filter":{"field":"playcount", "operator":"lessthan", "value":"1"}, "sort":{"method":"dateadded", "order":"descending"}, "properties":["title", "playcount", "showtitle", "tvshowid", "dateadded" ]}))
   answer = []
-  shows = set([d['tvshowid'] for d in data['result']['episodes']])
-  show_info = {}
-  for show in shows:
-    show_info[show] = GetTvShowDetails(show_id=show)
   for d in data['result']['episodes']:
-    showinfo = show_info[d['tvshowid']]
     answer.append({'title':d['title'], 'episodeid':d['episodeid'], 'show':d['showtitle'], 'label':d['label'], 'dateadded':datetime.datetime.strptime(d['dateadded'], "%Y-%m-%d %H:%M:%S")})
   return answer
 
@@ -878,47 +3264,120 @@ def SystemEjectMedia():
 
 # Misc helpers
 
+# Kodi always uses the same player ids for each kind of player
+PLAYER_TYPES = {0: 'audio', 1: 'video', 2: 'picture'}
+
+# What kind of player Kodi uses for each type of item
+ITEM_PLAYER_TYPES = {
+  'song': 'audio',
+  'picture': 'picture',
+  'movie': 'video',
+  'episode': 'video',
+  'musicvideo': 'video',
+  'channel': 'video',
+}
+
+
+# Keeps track of Kodi's active players so the player controls don't have to
+# ask with Player.GetActivePlayers before every command.  When we have a tcp
+# or ws connection to Kodi, Player.On* notifications keep the list current
+# for as long as that connection stays up.  Otherwise (or if a notification
+# is ambiguous) the list is only trusted for KODI_PLAYER_TTL seconds.
+class PlayerState(object):
+  def __init__(self):
+    self.players = None
+    self.updated = 0
+    self.source = None
+    self.lock = threading.Lock()
+
+  def _connection(self):
+    transport = GetSocketTransport()
+    if transport is not None:
+      return transport.conn
+
+  def _fresh(self):
+    if self.players is None:
+      return False
+    if self.source is not None and self.source is self._connection():
+      return True
+    return time.time() - self.updated < GetConfig().player_ttl
+
+  def get(self):
+    with self.lock:
+      if self._fresh():
+        return self.players
+    connection = self._connection()
+    data = SendCommand(RPCString("Player.GetActivePlayers"))
+    players = data.get("result", [])
+    with self.lock:
+      self.players = players
+      self.updated = time.time()
+      self.source = connection
+    return players
+
+  def invalidate(self):
+    with self.lock:
+      self.players = None
+
+  def on_notification(self, method, data):
+    if not method.startswith('Player.'):
+      return
+
+    data = data or {}
+    player = data.get('player') or {}
+    playertype = ITEM_PLAYER_TYPES.get((data.get('item') or {}).get('type'), PLAYER_TYPES.get(player.get('playerid')))
+
+    with self.lock:
+      if self.players is None:
+        return
+      if playertype is None:
+        self.players = None
+      elif method in ('Player.OnPlay', 'Player.OnResume', 'Player.OnAVStart', 'Player.OnPause'):
+        playerid = player.get('playerid')
+        if playerid is None:
+          self.players = None
+          return
+        # Audio and video replace each other; a slideshow can run alongside
+        players = [p for p in self.players if p.get('playerid') != playerid and (p.get('type') == 'picture') != (playertype == 'picture')]
+        players.append({'playerid': playerid, 'type': playertype})
+        self.players = players
+      elif method == 'Player.OnStop':
+        self.players = [p for p in self.players if p.get('type') != playertype]
+
+
+_player_state = PlayerState()
+AddNotificationListener(_player_state.on_notification)
+
+
+def GetActivePlayers():
+  return _player_state.get()
+
+
+def _FirstPlayerID(playertype):
+  for curitem in GetActivePlayers():
+    if curitem.get("type") in playertype:
+      return curitem.get("playerid")
+  return None
+
+
 # Get the first active player.
 def GetPlayerID(playertype=['audio', 'video', 'picture']):
-  data = SendCommand(RPCString("Player.GetActivePlayers"))
-  result = data.get("result", [])
-  if len(result) > 0:
-    for curitem in result:
-      if curitem.get("type") in playertype:
-        return curitem.get("playerid")
-  return None
+  return _FirstPlayerID(playertype)
+
 
 # Get the first active Video player.
 def GetVideoPlayerID(playertype=['video']):
-  data = SendCommand(RPCString("Player.GetActivePlayers"))
-  result = data.get("result", [])
-  if len(result) > 0:
-    for curitem in result:
-      if curitem.get("type") in playertype:
-        return curitem.get("playerid")
-  return None
+  return _FirstPlayerID(playertype)
 
 
 # Get the first active Audio player.
 def GetAudioPlayerID(playertype=['audio']):
-  data = SendCommand(RPCString("Player.GetActivePlayers"))
-  result = data.get("result", [])
-  if len(result) > 0:
-    for curitem in result:
-      if curitem.get("type") in playertype:
-        return curitem.get("playerid")
-  return None
+  return _FirstPlayerID(playertype)
 
 
 # Get the first active Picture player.
 def GetPicturePlayerID(playertype=['picture']):
-  data = SendCommand(RPCString("Player.GetActivePlayers"))
-  result = data.get("result", [])
-  if len(result) > 0:
-    for curitem in result:
-      if curitem.get("type") in playertype:
-        return curitem.get("playerid")
-  return None
+  return _FirstPlayerID(playertype)
 
 
 # Information about the video or audio that's currently playing
@@ -939,6 +3398,99 @@ def GetActivePlayProperties():
     return data['result']
 
 
+# Names of the languages Kodi is most likely to report for audio streams and
+# subtitles, by ISO 639-2 code.  Where the bibliographic and terminology
+# codes differ (ger/deu, fre/fra, ...) both are listed.
+LANGUAGE_NAMES = {
+  'afr': 'Afrikaans',
+  'alb': 'Albanian', 'sqi': 'Albanian',
+  'ara': 'Arabic',
+  'arm': 'Armenian', 'hye': 'Armenian',
+  'baq': 'Basque', 'eus': 'Basque',
+  'bel': 'Belarusian',
+  'ben': 'Bengali',
+  'bos': 'Bosnian',
+  'bul': 'Bulgarian',
+  'bur': 'Burmese', 'mya': 'Burmese',
+  'cat': 'Catalan',
+  'chi': 'Chinese', 'zho': 'Chinese',
+  'hrv': 'Croatian',
+  'cze': 'Czech', 'ces': 'Czech',
+  'dan': 'Danish',
+  'dut': 'Dutch', 'nld': 'Dutch',
+  'eng': 'English',
+  'est': 'Estonian',
+  'fil': 'Filipino',
+  'fin': 'Finnish',
+  'fre': 'French', 'fra': 'French',
+  'geo': 'Georgian', 'kat': 'Georgian',
+  'ger': 'German', 'deu': 'German',
+  'gre': 'Greek', 'ell': 'Greek',
+  'heb': 'Hebrew',
+  'hin': 'Hindi',
+  'hun': 'Hungarian',
+  'ice': 'Icelandic', 'isl': 'Icelandic',
+  'ind': 'Indonesian',
+  'gle': 'Irish',
+  'ita': 'Italian',
+  'jpn': 'Japanese',
+  'kan': 'Kannada',
+  'kaz': 'Kazakh',
+  'kor': 'Korean',
+  'lat': 'Latin',
+  'lav': 'Latvian',
+  'lit': 'Lithuanian',
+  'mac': 'Macedonian', 'mkd': 'Macedonian',
+  'may': 'Malay', 'msa': 'Malay',
+  'mal': 'Malayalam',
+  'mar': 'Marathi',
+  'nor': 'Norwegian', 'nob': 'Norwegian', 'nno': 'Norwegian',
+  'per': 'Persian', 'fas': 'Persian',
+  'pol': 'Polish',
+  'por': 'Portuguese',
+  'rum': 'Romanian', 'ron': 'Romanian',
+  'rus': 'Russian',
+  'srp': 'Serbian',
+  'slo': 'Slovak', 'slk': 'Slovak',
+  'slv': 'Slovenian',
+  'spa': 'Spanish',
+  'swa': 'Swahili',
+  'swe': 'Swedish',
+  'tam': 'Tamil',
+  'tel': 'Telugu',
+  'tha': 'Thai',
+  'tur': 'Turkish',
+  'ukr': 'Ukrainian',
+  'urd': 'Urdu',
+  'vie': 'Vietnamese',
+  'wel': 'Welsh', 'cym': 'Welsh',
+}
+
+# Languages that aren't in the table, as pycountry named them ('' if it
+# didn't know them either)
+_language_names = LRUCache(64)
+
+
+# Returns the speakable name of a language code, or None if it's unknown
+def LanguageName(code):
+  if not code:
+    return None
+  code = code.lower()
+  name = LANGUAGE_NAMES.get(code)
+  if name is not None:
+    return name
+
+  name = _language_names.get(code)
+  if name is None:
+    try:
+      import pycountry
+      name = pycountry.languages.get(bibliographic=code).name
+    except Exception:
+      name = ''
+    _language_names.set(code, name)
+  return name or None
+
+
 # Returns current subtitles as a speakable string
 def GetCurrentSubtitles():
   subs = ""
@@ -946,7 +3498,9 @@ def GetCurrentSubtitles():
   if curprops is not None:
     try:
       lang = curprops['currentsubtitle']['language']
-      subs = pycountry.languages.get(bibliographic=lang).name
+      subs = LanguageName(lang)
+      if subs is None:
+        return ""
       name = curprops['currentsubtitle']['name']
       if name:
         subs += " " + name
@@ -962,7 +3516,9 @@ def GetCurrentAudioStream():
   if curprops is not None:
     try:
       lang = curprops['currentaudiostream']['language']
-      stream = pycountry.languages.get(bibliographic=lang).name
+      stream = LanguageName(lang)
+      if stream is None:
+        return ""
       name = curprops['currentaudiostream']['name']
       if name:
         stream += " " + name
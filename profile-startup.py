@@ -0,0 +1,54 @@
+#!/bin/python
+
+# Prints how long each module takes to import when the skill starts up, to
+# help keep Lambda cold starts and gunicorn worker boots quick.  "total"
+# includes everything a module imports in turn, "own" leaves that out.
+#
+# Usage: `python profile-startup.py [module ...]` (defaults to wsgi)
+
+import __builtin__
+import os
+import sys
+import time
+
+costs = {}
+children = []
+real_import = __builtin__.__import__
+
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+  loaded = name in sys.modules
+  children.append(0.0)
+  start = time.time()
+  try:
+    return real_import(name, globals, locals, fromlist, level)
+  finally:
+    elapsed = time.time() - start
+    own = elapsed - children.pop()
+    if children:
+      children[-1] += elapsed
+    if not loaded:
+      total_before, own_before = costs.get(name, (0.0, 0.0))
+      costs[name] = (total_before + elapsed, own_before + own)
+
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+modules = sys.argv[1:] or ['wsgi']
+
+__builtin__.__import__ = timed_import
+start = time.time()
+for module in modules:
+  __import__(module)
+elapsed = time.time() - start
+__builtin__.__import__ = real_import
+
+print "%10s %10s  %s" % ("total ms", "own ms", "module")
+for name, (total, own) in sorted(costs.items(), key=lambda item: item[1][1], reverse=True):
+  if total >= 0.001:
+    print "%10.1f %10.1f  %s" % (total * 1000, own * 1000, name)
+print "Importing %s took %.1f ms" % (", ".join(modules), elapsed * 1000)
+
+# The heavy dependencies should only show up once a command needs them
+deferred = [name for name in ('requests', 'fuzzywuzzy', 'pycountry', 'pytz', 'aniso8601', 'verifier', 'websocket') if name not in sys.modules]
+if deferred:
+  print "Not imported until first use: %s" % (", ".join(deferred))
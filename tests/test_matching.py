@@ -0,0 +1,127 @@
+#!/bin/python
+
+# Checks that matchHeard's shortlists don't lose matches that scoring every
+# row would have found.  Run from the top of the repository with
+# `python -m unittest discover tests`.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
+
+import kodi
+
+
+SYLLABLES = ['ba', 'lo', 'ze', 'ki', 'mu', 'ra', 'to', 'ne', 'qu', 'il', 'on', 'ar', 'es', 'tu', 'vi', 'do']
+WORDS = ['night', 'blue', 'love', 'the', 'of', 'road', 'heart', 'cross', 'kites', 'song', 'dream', 'fire', 'rain', 'day', 'light', 'moon']
+
+
+# Lots of names built from the same few words and syllables, so that many
+# rows share trigrams with any query
+def library(size, seed=7):
+  rng = random.Random(seed)
+  names = set(['Blue Night Night Night', 'Quilo', 'Ze Lo', 'Ze Braon'])
+  while len(names) < size:
+    words = []
+    for i in range(rng.choice([1, 1, 2, 2, 3, 4])):
+      if rng.random() < 0.5:
+        words.append(rng.choice(WORDS))
+      else:
+        words.append(''.join([rng.choice(SYLLABLES) for j in range(rng.choice([1, 2, 3]))]))
+    names.add(' '.join(words).title())
+  return [{'label': name} for name in sorted(names)]
+
+
+def misspelled(name, rng):
+  letters = list(name.lower())
+  for i in range(rng.choice([1, 1, 2])):
+    letters[rng.randrange(len(letters))] = rng.choice('abcdefghijklmnopqrstuvwxyz')
+  return ''.join(letters)
+
+
+# What the matcher did before it had an index: score every row
+def best_of_all(heard, rows):
+  heard = fuzz_utils.full_process(heard, force_ascii=True)
+  best = (0, None)
+  for row in rows:
+    name = fuzz_utils.full_process(row['label'], force_ascii=True)
+    if name:
+      score = fuzz.QRatio(heard, name, full_process=False)
+      if score > best[0]:
+        best = (score, row)
+  if best[0] > kodi.FUZZY_THRESHOLD:
+    return best
+
+
+class QuietTestCase(unittest.TestCase):
+  def setUp(self):
+    self.stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+  def tearDown(self):
+    sys.stdout.close()
+    sys.stdout = self.stdout
+
+
+class PhoneticWordsTest(unittest.TestCase):
+  def test_digits_are_spelled_out(self):
+    twelve = kodi.phonetic_words('twelve monkeys')
+    self.assertEqual(kodi.phonetic_words('12 Monkeys'), twelve)
+    self.assertEqual(kodi.phonetic_words(u'\u0661\u0662 Monkeys'), twelve)
+    self.assertEqual(kodi.phonetic_words(u'\u00b9\u00b2 Monkeys'), twelve)
+
+
+class ShortlistTest(QuietTestCase):
+  rows = library(3000)
+
+  def assertMatchesLikeFullScan(self, index, queries):
+    for heard in queries:
+      expected = best_of_all(heard, self.rows)
+      located = kodi.matchHeard(heard, index)
+      if expected is None:
+        self.assertIsNone(located, heard)
+      else:
+        self.assertIsNotNone(located, heard)
+        # Another row with the same score would do just as well
+        name = fuzz_utils.full_process(located['label'], force_ascii=True)
+        self.assertEqual(fuzz.QRatio(fuzz_utils.full_process(heard, force_ascii=True), name, full_process=False), expected[0], heard)
+
+  def queries(self):
+    rng = random.Random(11)
+    return ['blge niglt night night', 'qxilo', 'ze mo', 'zj braon'] + [misspelled(rng.choice(self.rows)['label'], rng) for i in range(40)]
+
+  def test_short_names_make_the_shortlist(self):
+    index = kodi.MatchIndex(self.rows)
+    index._build_fuzzy()
+    position = [row['label'] for row in self.rows].index('Quilo')
+    self.assertIn(position, index._candidates(['qxilo']))
+
+  def test_rows_tied_at_the_cutoff_are_kept(self):
+    rows = [{'label': 'Moon %03d' % (i)} for i in range(kodi.FUZZY_CANDIDATES * 2)]
+    index = kodi.MatchIndex(rows)
+    index._build_fuzzy()
+    self.assertEqual(len(index._candidates(['moon'])), len(rows))
+
+  def test_matches_like_a_full_scan(self):
+    self.assertMatchesLikeFullScan(kodi.MatchIndex(self.rows), self.queries())
+
+  def test_snapshot_matches_like_a_full_scan(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'songs.snapshot')
+      kodi.WriteSnapshot(path, self.rows, ['label'])
+      snapshot = kodi.OpenSnapshot(path)
+      self.assertMatchesLikeFullScan(snapshot.match_index('label'), self.queries())
+    finally:
+      shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,6 +1,8 @@
 import os
 import base64
+import collections
 import posixpath
+import threading
 from datetime import datetime
 from six.moves.urllib.parse import urlparse
 from six.moves.urllib.request import urlopen
@@ -11,13 +13,24 @@ from OpenSSL import crypto
 class VerificationError(Exception): pass
 
 
+# Validated certificates by chain URL, so Amazon's certificate is only
+# fetched and checked once for as long as it stays valid
+CERT_CACHE_SIZE = 8
+_cert_cache = collections.OrderedDict()
+_cert_cache_lock = threading.Lock()
+
+
 def load_certificate(cert_url):
   if not _valid_certificate_url(cert_url):
     raise VerificationError("Certificate URL verification failed")
+  cert = _cached_certificate(cert_url)
+  if cert is not None:
+    return cert
   cert_data = urlopen(cert_url).read()
   cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_data)
   if not _valid_certificate(cert):
     raise VerificationError("Certificate verification failed")
+  _cache_certificate(cert_url, cert)
   return cert
 
 
@@ -29,9 +42,14 @@ def verify_signature(cert, signature, signed_data):
     raise VerificationError(e)
 
 
+# Seconds a request's timestamp may be off by.  wsgi.py remembers request ids
+# for as long, so a replayed request can't run twice.
+TIMESTAMP_TOLERANCE = 150
+
+
 def verify_timestamp(timestamp):
   dt = datetime.utcnow() - timestamp.replace(tzinfo=None)
-  if dt.seconds > 150:
+  if dt.seconds > TIMESTAMP_TOLERANCE:
     raise VerificationError("Timestamp verification failed")
 
 
@@ -44,9 +62,33 @@ def _valid_certificate_url(cert_url):
   return False
 
 
-def _valid_certificate(cert):
+def _cached_certificate(cert_url):
+  with _cert_cache_lock:
+    entry = _cert_cache.pop(cert_url, None)
+    if entry is None:
+      return None
+    cert, not_after = entry
+    if datetime.utcnow() >= not_after:
+      return None
+    _cert_cache[cert_url] = entry
+    return cert
+
+
+def _cache_certificate(cert_url, cert):
+  with _cert_cache_lock:
+    _cert_cache.pop(cert_url, None)
+    _cert_cache[cert_url] = (cert, _not_after(cert))
+    while len(_cert_cache) > CERT_CACHE_SIZE:
+      _cert_cache.popitem(last=False)
+
+
+def _not_after(cert):
   not_after = cert.get_notAfter().decode('utf-8')
-  not_after = datetime.strptime(not_after, '%Y%m%d%H%M%SZ')
+  return datetime.strptime(not_after, '%Y%m%d%H%M%SZ')
+
+
+def _valid_certificate(cert):
+  not_after = _not_after(cert)
   if datetime.utcnow() >= not_after:
     return False
   found = False
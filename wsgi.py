@@ -27,36 +27,42 @@ THE SOFTWARE.
 
 # For a complete discussion, see http://forum.kodi.tv/showthread.php?tid=254502
 
+import collections
 import datetime
-import pytz
 import json
 import os.path
 import random
 import re
 import string
 import sys
+import threading
 import time
-from multiprocessing import Process
 from yaep import populate_env
 from yaep import env
 
 sys.path += [os.path.dirname(__file__)]
 
-try:
-  import aniso8601
-  import verifier
-except:
-  # cert/appid verification dependencies are optional installs
-  pass
-
+# pytz and the request verification modules are imported
+# where they're needed, to keep cold starts quick.
 import kodi
 
 
 ENV_FILE = os.path.join(os.path.dirname(__file__), ".env")
 
-def setup_env():
+_env_loaded = False
+
+# Load the .env file into the environment.  This only needs to happen once
+# per process; pass reload=True to pick up changes to the file (or to the
+# environment) without restarting.
+def setup_env(reload=False):
+  global _env_loaded
+
+  if _env_loaded and not reload:
+    return
   os.environ['ENV_FILE'] = ENV_FILE
   populate_env()
+  kodi.ReloadConfig()
+  _env_loaded = True
   #print os.environ
 
 
@@ -237,6 +243,7 @@ def alexa_current_playitem_time_remaining(slots):
       answer = 'There are %d minutes remaining' % (minsleft)
       tz = env('SKILL_TZ')
       if minsleft > 9 and tz and tz != 'None':
+        import pytz
         utctime = datetime.datetime.now(pytz.utc)
         loctime = utctime.astimezone(pytz.timezone(tz))
         endtime = loctime + datetime.timedelta(minutes=minsleft)
@@ -303,7 +310,7 @@ def alexa_player_seek_bigforward(slots):
 
 
 # Handle the PlayerSeekBigBackward intent.
-def alexa_player_seek_bigforward(slots):
+def alexa_player_seek_bigbackward(slots):
   card_title = 'Big Step backward'
   print card_title
   sys.stdout.flush()
@@ -336,10 +343,7 @@ def alexa_listen_artist(slots):
       for song in songs:
         songs_array.append(song['songid'])
 
-      kodi.Stop()
-      kodi.ClearAudioPlaylist()
-      kodi.AddSongsToPlaylist(songs_array, True)
-      kodi.StartAudioPlaylist()
+      kodi.PlaySongs(songs_array, True)
       return build_alexa_response('Playing %s' % (heard_artist), card_title)
     else:
       return build_alexa_response('Could not find %s' % (heard_artist), card_title)
@@ -373,10 +377,7 @@ def alexa_listen_album(slots):
 
           if album_located:
             album_result = album_located['albumid']
-            kodi.Stop()
-            kodi.ClearAudioPlaylist()
-            kodi.AddAlbumToPlaylist(album_result)
-            kodi.StartAudioPlaylist()
+            kodi.PlayAlbum(album_result)
           else:
             return build_alexa_response('Could not find album, %s by %s' % (heard_album, heard_artist), card_title)
           return build_alexa_response('Playing album, %s by %s' % (heard_album, heard_artist), card_title)
@@ -395,10 +396,7 @@ def alexa_listen_album(slots):
 
       if album_located:
         album_result = album_located['albumid']
-        kodi.Stop()
-        kodi.ClearAudioPlaylist()
-        kodi.AddAlbumToPlaylist(album_result)
-        kodi.StartAudioPlaylist()
+        kodi.PlayAlbum(album_result)
       else:
         return build_alexa_response('Could not find album, %s' % (heard_album), card_title)
       return build_alexa_response('Playing album, %s' % (heard_album), card_title)
@@ -432,10 +430,7 @@ def alexa_listen_song(slots):
 
           if song_located:
             song_result = song_located['songid']
-            kodi.Stop()
-            kodi.ClearAudioPlaylist()
-            kodi.AddSongToPlaylist(song_result)
-            kodi.StartAudioPlaylist()
+            kodi.PlaySong(song_result)
           else:
             return build_alexa_response('Could not find song, %s by %s' % (heard_song, heard_artist), card_title)
           return build_alexa_response('Playing song, %s by %s' % (heard_song, heard_artist), card_title)
@@ -447,22 +442,14 @@ def alexa_listen_song(slots):
     else:
       return build_alexa_response('Could not find song, %s by %s' % (heard_artist), card_title)
   else:
-    songs = kodi.GetSongs()
-    if 'result' in songs and 'songs' in songs['result']:
-      songs_list = songs['result']['songs']
-      song_located = kodi.matchHeard(heard_song, songs_list, 'label')
-
-      if song_located:
-        song_result = song_located['songid']
-        kodi.Stop()
-        kodi.ClearAudioPlaylist()
-        kodi.AddSongToPlaylist(song_result)
-        kodi.StartAudioPlaylist()
-      else:
-        return build_alexa_response('Could not find song, %s' % (heard_song), card_title)
-      return build_alexa_response('Playing song, %s' % (heard_song), card_title)
+    song_located = kodi.matchHeard(heard_song, kodi.IterSongs(), 'label')
+
+    if song_located:
+      song_result = song_located['songid']
+      kodi.PlaySong(song_result)
     else:
       return build_alexa_response('Could not find song, %s' % (heard_song), card_title)
+    return build_alexa_response('Playing song, %s' % (heard_song), card_title)
 
 
 # Handle the ListenToAlbumOrSong intent.
@@ -491,10 +478,7 @@ def alexa_listen_album_or_song(slots):
 
         if album_located:
           album_result = album_located['albumid']
-          kodi.Stop()
-          kodi.ClearAudioPlaylist()
-          kodi.AddAlbumToPlaylist(album_result)
-          kodi.StartAudioPlaylist()
+          kodi.PlayAlbum(album_result)
           return build_alexa_response('Playing album, %s by %s' % (heard_search, heard_artist), card_title)
         else:
           songs = kodi.GetArtistSongs(located['artistid'])
@@ -504,10 +488,7 @@ def alexa_listen_album_or_song(slots):
 
             if song_located:
               song_result = song_located['songid']
-              kodi.Stop()
-              kodi.ClearAudioPlaylist()
-              kodi.AddSongToPlaylist(song_result)
-              kodi.StartAudioPlaylist()
+              kodi.PlaySong(song_result)
               return build_alexa_response('Playing song, %s by %s' % (heard_search, heard_artist), card_title)
             else:
               return build_alexa_response('Could not find %s by %s' % (heard_search, heard_artist), card_title)
@@ -538,10 +519,7 @@ def alexa_listen_recently_added_songs(slots):
     for song in songs:
       songs_array.append(song['songid'])
 
-    kodi.Stop()
-    kodi.ClearAudioPlaylist()
-    kodi.AddSongsToPlaylist(songs_array, True)
-    kodi.StartAudioPlaylist()
+    kodi.PlaySongs(songs_array, True)
     return build_alexa_response('Playing recently added songs', card_title)
   return build_alexa_response('No recently added songs found', card_title)
 
@@ -569,13 +547,9 @@ def alexa_listen_audio_playlist(slots, shuffle=False):
       for song in songs:
         songs_array.append(song['id'])
 
-      kodi.Stop()
-      kodi.ClearAudioPlaylist()
-      kodi.AddSongsToPlaylist(songs_array, True)
-      kodi.StartAudioPlaylist()
+      kodi.PlaySongs(songs_array, True)
     else:
-      kodi.Stop()
-      kodi.StartAudioPlaylist(playlist)
+      kodi.PlayAudioPlaylist(playlist)
     return build_alexa_response('%s playlist %s' % (op, heard_search), card_title)
   else:
     return build_alexa_response('I could not find a playlist named %s' % (heard_search), card_title)
@@ -589,18 +563,14 @@ def alexa_shuffle_audio_playlist(slots):
 # Handle the PartyMode intent.
 def alexa_party_play(slots):
   card_title = 'Party Mode'
-  songs = kodi.GetSongs()
+  songs_array = []
 
-  if 'result' in songs and 'songs' in songs['result']:
-    songs_array = []
-
-    for song in songs['result']['songs']:
-      songs_array.append(song['songid'])
+  songs = kodi.IterSongs()
+  for song in songs:
+    songs_array.append(song['songid'])
 
-    kodi.Stop()
-    kodi.ClearAudioPlaylist()
-    kodi.AddSongsToPlaylist(songs_array, True)
-    kodi.StartAudioPlaylist()
+  if songs_array and not songs.failed:
+    kodi.PlaySongs(songs_array, True)
     return build_alexa_response('Starting party play', card_title)
   else:
     return build_alexa_response('Error parsing results', card_title)
@@ -1147,12 +1117,8 @@ def alexa_clean_video(slots):
   print card_title
   sys.stdout.flush()
 
-  # Use threading to solve the call from returing too late
-  c = Process(target=kodi.CleanVideo)
-  c.daemon = True
-  c.start()
-
-  time.sleep(2)
+  # Cleaning takes a while, so don't wait for Kodi to finish
+  kodi.RunInBackground('CleanVideo', kodi.CleanVideo)
 
   answer = "Cleaning video library"
   return build_alexa_response(answer, card_title)
@@ -1164,7 +1130,7 @@ def alexa_update_video(slots):
   print card_title
   sys.stdout.flush()
 
-  kodi.UpdateVideo()
+  kodi.RunInBackground('UpdateVideo', kodi.UpdateVideo)
 
   answer = "Updating video library"
   return build_alexa_response(answer, card_title)
@@ -1176,12 +1142,8 @@ def alexa_clean_audio(slots):
   print card_title
   sys.stdout.flush()
 
-  #Use threading to solve the call from returing too late
-  c = Process(target=kodi.CleanMusic)
-  c.daemon = True
-  c.start()
-
-  time.sleep(2)
+  # Cleaning takes a while, so don't wait for Kodi to finish
+  kodi.RunInBackground('CleanMusic', kodi.CleanMusic)
 
   answer = "Cleaning audio library"
   return build_alexa_response(answer, card_title)
@@ -1193,7 +1155,7 @@ def alexa_update_audio(slots):
   print card_title
   sys.stdout.flush()
 
-  kodi.UpdateMusic()
+  kodi.RunInBackground('UpdateMusic', kodi.UpdateMusic)
 
   answer = "Updating audio library"
   return build_alexa_response(answer, card_title)
@@ -1522,13 +1484,9 @@ def alexa_watch_video_playlist(slots, shuffle=False):
       for video in videos:
         videos_array.append(video['file'])
 
-      kodi.Stop()
-      kodi.ClearVideoPlaylist()
-      kodi.AddVideosToPlaylist(videos_array, True)
-      kodi.StartVideoPlaylist()
+      kodi.PlayVideos(videos_array, True)
     else:
-      kodi.Stop()
-      kodi.StartVideoPlaylist(playlist)
+      kodi.PlayVideoPlaylist(playlist)
     return build_alexa_response('%s playlist %s' % (op, heard_search), card_title)
   else:
     return build_alexa_response('I could not find a playlist named %s' % (heard_search), card_title)
@@ -1563,10 +1521,7 @@ def alexa_shuffle_playlist(slots):
       for video in videos:
         videos_array.append(video['file'])
 
-      kodi.Stop()
-      kodi.ClearVideoPlaylist()
-      kodi.AddVideosToPlaylist(videos_array, True)
-      kodi.StartVideoPlaylist()
+      kodi.PlayVideos(videos_array, True)
       return build_alexa_response('Shuffling video playlist %s' % (heard_search), card_title)
     else:
       playlist = kodi.FindAudioPlaylist(heard_search)
@@ -1578,10 +1533,7 @@ def alexa_shuffle_playlist(slots):
         for song in songs:
           songs_array.append(song['id'])
 
-        kodi.Stop()
-        kodi.ClearAudioPlaylist()
-        kodi.AddSongsToPlaylist(songs_array, True)
-        kodi.StartAudioPlaylist()
+        kodi.PlaySongs(songs_array, True)
         return build_alexa_response('Shuffling audio playlist %s' % (heard_search), card_title)
 
     return build_alexa_response('I could not find a playlist named %s' % (heard_search), card_title)
@@ -1786,100 +1738,222 @@ def prepare_help_message():
   return build_alexa_response(help, card_title)
 
 
-# This maps the Intent names to the functions that provide the corresponding Alexa response.
+# This maps the Intent names to the functions that provide the corresponding
+# Alexa response.  An optional third element holds settings for the intent:
+#
+#   slots: names of the slots the handler looks at.  Alexa leaves out slots
+#     that weren't filled, so these are passed to the handler as empty dicts.
+#   fire_and_forget: the answer doesn't depend on what Kodi replies.
+#   cacheable: the response may be replayed to a retry of the same request
+#     (default True).  Set to False for answers that go stale quickly.
 INTENTS = [
-  ['NewShowInquiry', alexa_new_show_inquiry],
-  ['CurrentPlayItemInquiry', alexa_current_playitem_inquiry],
-  ['CurrentPlayItemTimeRemaining', alexa_current_playitem_time_remaining],
+  ['NewShowInquiry', alexa_new_show_inquiry, {'slots': ['Show']}],
+  ['CurrentPlayItemInquiry', alexa_current_playitem_inquiry, {'cacheable': False}],
+  ['CurrentPlayItemTimeRemaining', alexa_current_playitem_time_remaining, {'cacheable': False}],
   ['WhatNewAlbums', alexa_what_new_albums],
-  ['WhatNewMovies', alexa_what_new_movies],
+  ['WhatNewMovies', alexa_what_new_movies, {'slots': ['Genre']}],
   ['WhatNewShows', alexa_what_new_episodes],
-  ['WhatAlbums', alexa_what_albums],
-  ['ListenToArtist', alexa_listen_artist],
-  ['ListenToAlbum', alexa_listen_album],
-  ['ListenToSong', alexa_listen_song],
-  ['ListenToAlbumOrSong', alexa_listen_album_or_song],
-  ['ListenToAudioPlaylist', alexa_listen_audio_playlist],
+  ['WhatAlbums', alexa_what_albums, {'slots': ['Artist']}],
+  ['ListenToArtist', alexa_listen_artist, {'slots': ['Artist']}],
+  ['ListenToAlbum', alexa_listen_album, {'slots': ['Artist', 'Album']}],
+  ['ListenToSong', alexa_listen_song, {'slots': ['Artist', 'Song']}],
+  ['ListenToAlbumOrSong', alexa_listen_album_or_song, {'slots': ['Artist', 'Album', 'Song']}],
+  ['ListenToAudioPlaylist', alexa_listen_audio_playlist, {'slots': ['AudioPlaylist']}],
   ['ListenToAudioPlaylistRecent', alexa_listen_recently_added_songs],
-  ['WatchRandomMovie', alexa_watch_random_movie],
-  ['WatchRandomEpisode', alexa_watch_random_episode],
-  ['WatchMovie', alexa_watch_movie],
-  ['WatchEpisode', alexa_watch_episode],
-  ['WatchNextEpisode', alexa_watch_next_episode],
-  ['WatchLatestEpisode', alexa_watch_newest_episode],
+  ['WatchRandomMovie', alexa_watch_random_movie, {'slots': ['Genre']}],
+  ['WatchRandomEpisode', alexa_watch_random_episode, {'slots': ['Show']}],
+  ['WatchMovie', alexa_watch_movie, {'slots': ['Movie']}],
+  ['WatchEpisode', alexa_watch_episode, {'slots': ['Show', 'Episode', 'Season']}],
+  ['WatchNextEpisode', alexa_watch_next_episode, {'slots': ['Show']}],
+  ['WatchLatestEpisode', alexa_watch_newest_episode, {'slots': ['Show']}],
   ['WatchLastShow', alexa_watch_last_show],
-  ['WatchVideoPlaylist', alexa_watch_video_playlist],
-  ['ShuffleAudioPlaylist', alexa_shuffle_audio_playlist],
-  ['ShuffleVideoPlaylist', alexa_shuffle_video_playlist],
-  ['ShufflePlaylist', alexa_shuffle_playlist],
-  ['PlayPause', alexa_play_pause],
-  ['Stop', alexa_stop],
-  ['Skip', alexa_skip],
-  ['Prev', alexa_prev],
-  ['StartOver', alexa_start_over],
-  ['PlayerSeekSmallForward', alexa_player_seek_smallforward],
-  ['PlayerSeekBigForward', alexa_player_seek_bigforward],
-  ['PlayerSeekSmallBackward', alexa_player_seek_smallbackward],
-  ['PlayerSeekBigBackward', alexa_player_seek_bigforward],
-  ['Home', alexa_go_home],
-  ['Back', alexa_back],
-  ['Up', alexa_up],
-  ['Down', alexa_down],
-  ['Right', alexa_right],
-  ['Left', alexa_left],
-  ['Select', alexa_select],
-  ['Menu', alexa_context_menu],
-  ['PageUp', alexa_pageup],
-  ['PageDown', alexa_pagedown],
-  ['Fullscreen', alexa_fullscreen],
-  ['Mute', alexa_mute],
+  ['WatchVideoPlaylist', alexa_watch_video_playlist, {'slots': ['VideoPlaylist']}],
+  ['ShuffleAudioPlaylist', alexa_shuffle_audio_playlist, {'slots': ['AudioPlaylist']}],
+  ['ShuffleVideoPlaylist', alexa_shuffle_video_playlist, {'slots': ['VideoPlaylist']}],
+  ['ShufflePlaylist', alexa_shuffle_playlist, {'slots': ['AudioPlaylist', 'VideoPlaylist']}],
+  ['PlayPause', alexa_play_pause, {'fire_and_forget': True}],
+  ['Stop', alexa_stop, {'fire_and_forget': True}],
+  ['Skip', alexa_skip, {'fire_and_forget': True}],
+  ['Prev', alexa_prev, {'fire_and_forget': True}],
+  ['StartOver', alexa_start_over, {'fire_and_forget': True}],
+  ['PlayerSeekSmallForward', alexa_player_seek_smallforward, {'fire_and_forget': True}],
+  ['PlayerSeekBigForward', alexa_player_seek_bigforward, {'fire_and_forget': True}],
+  ['PlayerSeekSmallBackward', alexa_player_seek_smallbackward, {'fire_and_forget': True}],
+  ['PlayerSeekBigBackward', alexa_player_seek_bigbackward, {'fire_and_forget': True}],
+  ['Home', alexa_go_home, {'fire_and_forget': True}],
+  ['Back', alexa_back, {'fire_and_forget': True}],
+  ['Up', alexa_up, {'fire_and_forget': True}],
+  ['Down', alexa_down, {'fire_and_forget': True}],
+  ['Right', alexa_right, {'fire_and_forget': True}],
+  ['Left', alexa_left, {'fire_and_forget': True}],
+  ['Select', alexa_select, {'fire_and_forget': True}],
+  ['Menu', alexa_context_menu, {'fire_and_forget': True}],
+  ['PageUp', alexa_pageup, {'fire_and_forget': True}],
+  ['PageDown', alexa_pagedown, {'fire_and_forget': True}],
+  ['Fullscreen', alexa_fullscreen, {'fire_and_forget': True}],
+  ['Mute', alexa_mute, {'fire_and_forget': True}],
   ['VolumeUp', alexa_volume_up],
   ['VolumeDown', alexa_volume_down],
-  ['VolumeSet', alexa_volume_set],
-  ['VolumeSetPct', alexa_volume_set_pct],
+  ['VolumeSet', alexa_volume_set, {'slots': ['Volume']}],
+  ['VolumeSetPct', alexa_volume_set_pct, {'slots': ['Volume']}],
   ['SubtitlesOn', alexa_subtitles_on],
   ['SubtitlesOff', alexa_subtitles_off],
   ['SubtitlesNext', alexa_subtitles_next],
   ['SubtitlesPrevious', alexa_subtitles_previous],
   ['AudioStreamNext', alexa_audiostream_next],
   ['AudioStreamPrevious', alexa_audiostream_previous],
-  ['PlayerMoveUp', alexa_player_move_up],
-  ['PlayerMoveDown', alexa_player_move_down],
-  ['PlayerMoveLeft', alexa_player_move_left],
-  ['PlayerMoveRight', alexa_player_move_right],
-  ['PlayerRotateClockwise', alexa_player_rotate_clockwise],
-  ['PlayerRotateCounterClockwise', alexa_player_rotate_counterclockwise],
-  ['PlayerZoomHold', alexa_player_zoom_hold],
-  ['PlayerZoomIn', alexa_player_zoom_in],
-  ['PlayerZoomInMoveUp', alexa_player_zoom_in_move_up],
-  ['PlayerZoomInMoveDown', alexa_player_zoom_in_move_down],
-  ['PlayerZoomInMoveLeft', alexa_player_zoom_in_move_left],
-  ['PlayerZoomInMoveRight', alexa_player_zoom_in_move_right],
-  ['PlayerZoomOut', alexa_player_zoom_out],
-  ['PlayerZoomOutMoveUp', alexa_player_zoom_out_move_up],
-  ['PlayerZoomOutMoveDown', alexa_player_zoom_out_move_down],
-  ['PlayerZoomOutMoveLeft', alexa_player_zoom_out_move_left],
-  ['PlayerZoomOutMoveRight', alexa_player_zoom_out_move_right],
-  ['PlayerZoomReset', alexa_player_zoom_reset],
+  ['PlayerMoveUp', alexa_player_move_up, {'fire_and_forget': True}],
+  ['PlayerMoveDown', alexa_player_move_down, {'fire_and_forget': True}],
+  ['PlayerMoveLeft', alexa_player_move_left, {'fire_and_forget': True}],
+  ['PlayerMoveRight', alexa_player_move_right, {'fire_and_forget': True}],
+  ['PlayerRotateClockwise', alexa_player_rotate_clockwise, {'fire_and_forget': True}],
+  ['PlayerRotateCounterClockwise', alexa_player_rotate_counterclockwise, {'fire_and_forget': True}],
+  ['PlayerZoomHold', alexa_player_zoom_hold, {'fire_and_forget': True}],
+  ['PlayerZoomIn', alexa_player_zoom_in, {'fire_and_forget': True}],
+  ['PlayerZoomInMoveUp', alexa_player_zoom_in_move_up, {'fire_and_forget': True}],
+  ['PlayerZoomInMoveDown', alexa_player_zoom_in_move_down, {'fire_and_forget': True}],
+  ['PlayerZoomInMoveLeft', alexa_player_zoom_in_move_left, {'fire_and_forget': True}],
+  ['PlayerZoomInMoveRight', alexa_player_zoom_in_move_right, {'fire_and_forget': True}],
+  ['PlayerZoomOut', alexa_player_zoom_out, {'fire_and_forget': True}],
+  ['PlayerZoomOutMoveUp', alexa_player_zoom_out_move_up, {'fire_and_forget': True}],
+  ['PlayerZoomOutMoveDown', alexa_player_zoom_out_move_down, {'fire_and_forget': True}],
+  ['PlayerZoomOutMoveLeft', alexa_player_zoom_out_move_left, {'fire_and_forget': True}],
+  ['PlayerZoomOutMoveRight', alexa_player_zoom_out_move_right, {'fire_and_forget': True}],
+  ['PlayerZoomReset', alexa_player_zoom_reset, {'fire_and_forget': True}],
   ['CleanVideo', alexa_clean_video],
   ['UpdateVideo', alexa_update_video],
   ['CleanAudio', alexa_clean_audio],
   ['UpdateAudio', alexa_update_audio],
   ['PartyMode', alexa_party_play],
-  ['AddonExecute', alexa_addon_execute],
-  ['AddonGlobalSearch', alexa_addon_globalsearch],
-  ['Hibernate', alexa_hibernate],
-  ['Reboot', alexa_reboot],
-  ['Shutdown', alexa_shutdown],
-  ['Suspend', alexa_suspend],
-  ['EjectMedia', alexa_ejectmedia]
+  ['AddonExecute', alexa_addon_execute, {'slots': ['Addon']}],
+  ['AddonGlobalSearch', alexa_addon_globalsearch, {'slots': ['Artist', 'Album', 'Song', 'Movie', 'Show']}],
+  ['Hibernate', alexa_hibernate, {'fire_and_forget': True}],
+  ['Reboot', alexa_reboot, {'fire_and_forget': True}],
+  ['Shutdown', alexa_shutdown, {'fire_and_forget': True}],
+  ['Suspend', alexa_suspend, {'fire_and_forget': True}],
+  ['EjectMedia', alexa_ejectmedia, {'fire_and_forget': True}]
 ]
 
 
+IntentSpec = collections.namedtuple('IntentSpec', ['name', 'handler', 'slots', 'fire_and_forget', 'cacheable'])
+
+
+# Turn the INTENTS list into a table keyed by intent name
+def compile_intents(intents):
+  table = {}
+  for intent in intents:
+    options = intent[2] if len(intent) > 2 else {}
+    table[intent[0]] = IntentSpec(
+      name=intent[0],
+      handler=intent[1],
+      slots=tuple(options.get('slots', ())),
+      fire_and_forget=options.get('fire_and_forget', False),
+      cacheable=options.get('cacheable', True),
+    )
+  return table
+
+
+INTENT_TABLE = compile_intents(INTENTS)
+
+
+# Alexa retries requests that take too long to answer, and with
+# SKILL_VERIFY_CERT a captured request passes verification for as long as its
+# timestamp is within verifier.TIMESTAMP_TOLERANCE.  Both arrive with the same
+# requestId, so responses are kept by requestId for at least that long: a
+# repeat gets the stored response without running the intent again, and a
+# repeat that arrives while the first is still running waits for it instead.
+# The window below covers retries; verified requests widen it to the
+# verifier's tolerance.
+REQUEST_CACHE_SIZE = 256
+REQUEST_CACHE_WINDOW = 150
+
+
+class PendingResponse(object):
+  def __init__(self):
+    self.started = time.time()
+    self.done = threading.Event()
+    self.response = None
+
+
+class RequestCache(object):
+  def __init__(self, size=REQUEST_CACHE_SIZE, window=REQUEST_CACHE_WINDOW):
+    self.size = size
+    self.window = window
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  # Keep responses for at least this many seconds
+  def keep_for(self, seconds):
+    with self.lock:
+      self.window = max(self.window, seconds)
+
+  def _expire(self):
+    cutoff = time.time() - self.window
+    while self.entries:
+      request_id, entry = next(self.entries.iteritems())
+      if entry.started >= cutoff and len(self.entries) <= self.size:
+        break
+      del self.entries[request_id]
+
+  # Returns handler()'s response, or the one from the first run of the same
+  # request.  Uncacheable responses are only shared with repeats that arrive
+  # while the first run is still going.
+  def run(self, request_id, handler, cacheable=True):
+    if not request_id:
+      return handler()
+
+    with self.lock:
+      entry = self.entries.get(request_id)
+      first = entry is None
+      if first:
+        entry = self.entries[request_id] = PendingResponse()
+      self._expire()
+
+    if not first:
+      print "Repeated request %s, answering with the first response" % (request_id)
+      entry.done.wait(self.window)
+      if entry.response is not None:
+        return entry.response
+      # The first attempt failed or is stuck; have a go ourselves
+      return handler()
+
+    try:
+      entry.response = handler()
+    finally:
+      with self.lock:
+        if entry.response is None or not cacheable:
+          if self.entries.get(request_id) is entry:
+            del self.entries[request_id]
+      entry.done.set()
+    return entry.response
+
+
+_request_cache = RequestCache()
+
+
 def on_session_started(session_started_request, session):
   print("on_session_started: requestId=" + session_started_request['requestId'] + ", sessionId=" + session['sessionId'])
 
 
+# Answer a LaunchRequest or IntentRequest, or a repeat of one
+def on_request(request, session):
+  cacheable = True
+  if request['type'] == 'IntentRequest':
+    spec = INTENT_TABLE.get(request['intent']['name'])
+    cacheable = spec is None or spec.cacheable
+  return _request_cache.run(request.get('requestId'), lambda: dispatch_request(request, session), cacheable)
+
+
+def dispatch_request(request, session):
+  if request['type'] == 'LaunchRequest':
+    # This is the type when you just say "Open <app>"
+    return prepare_help_message()
+  elif request['type'] == 'IntentRequest':
+    return on_intent(request, session)
+  else:
+    return build_alexa_response("I received an unexpected request type.")
+
+
 def on_intent(intent_request, session):
   print("on_intent: requestId=" + intent_request['requestId'] + ", sessionId=" + session['sessionId'])
 
@@ -1887,20 +1961,24 @@ def on_intent(intent_request, session):
   intent_name = intent_request['intent']['name']
   intent_slots = intent_request['intent'].get('slots',{})
 
-  # Dispatch to your skill's intent handlers
-  response = None
-
   print('Requested intent: %s' % (intent_name))
   sys.stdout.flush()
 
-  # Run the function associated with the intent
-  for one_intent in INTENTS:
-    if intent_name == one_intent[0]:
-      return one_intent[1](intent_slots)
-      break
-  if not response:
+  # Dispatch to your skill's intent handlers
+  spec = INTENT_TABLE.get(intent_name)
+  if not spec:
     return prepare_help_message()
 
+  for slot in spec.slots:
+    intent_slots.setdefault(slot, {})
+
+  # Run the function associated with the intent.  Control intents answer
+  # the same whatever Kodi says, so they needn't wait for it to say it.
+  if spec.fire_and_forget:
+    with kodi.FireAndForget():
+      return spec.handler(intent_slots)
+  return spec.handler(intent_slots)
+
 
 def verify_application_id(candidate):
   if env('SKILL_APPID'):
@@ -1913,6 +1991,10 @@ def verify_application_id(candidate):
       raise
 
 
+# Seconds lambda_handler waits for background jobs before returning
+LAMBDA_DRAIN_TIMEOUT = 2
+
+
 # The main entry point for lambda
 def lambda_handler(event, context):
   appid = event['session']['application']['applicationId']
@@ -1926,12 +2008,12 @@ def lambda_handler(event, context):
   if event['session']['new']:
     on_session_started({'requestId': event['request']['requestId']}, event['session'])
 
-  if event['request']['type'] == "LaunchRequest":
-    return prepare_help_message()
-  elif event['request']['type'] == "IntentRequest":
-    return on_intent(event['request'], event['session'])
-  else:
-    return build_alexa_response("I received an unexpected request type.")
+  response = on_request(event['request'], event['session'])
+
+  # Lambda freezes the container as soon as we return, so give background
+  # jobs a moment to at least reach Kodi
+  kodi.DrainBackgroundJobs(LAMBDA_DRAIN_TIMEOUT)
+  return response
 
 
 def wsgi_handler(environ, start_response):
@@ -1952,8 +2034,13 @@ def wsgi_handler(environ, start_response):
     print("wsgi_handler: applicationId=" + appid)
 
     # Verify the request is coming from Amazon and includes a valid signature.
-    try:
-      if env('SKILL_VERIFY_CERT'):
+    if env('SKILL_VERIFY_CERT'):
+      # cert/appid verification dependencies are optional installs
+      import aniso8601
+      import verifier
+      _request_cache.keep_for(verifier.TIMESTAMP_TOLERANCE)
+
+      try:
         print "Verifying certificate is valid..."
         cert_url = environ['HTTP_SIGNATURECERTCHAINURL']
         signature = environ['HTTP_SIGNATURE']
@@ -1961,9 +2048,9 @@ def wsgi_handler(environ, start_response):
         verifier.verify_signature(cert, signature, body)
         timestamp = aniso8601.parse_datetime(alexa_request['timestamp'])
         verifier.verify_timestamp(timestamp)
-    except verifier.VerificationError as e:
-      print e.args[0]
-      raise
+      except verifier.VerificationError as e:
+        print e.args[0]
+        raise
 
     # Verify the application ID is what the user expects
     verify_application_id(appid)
@@ -1971,15 +2058,7 @@ def wsgi_handler(environ, start_response):
     if alexa_session['new']:
       on_session_started({'requestId': alexa_request['requestId']}, alexa_session)
 
-    if alexa_request['type'] == 'LaunchRequest':
-      # This is the type when you just say "Open <app>"
-      response = prepare_help_message()
-
-    elif alexa_request['type'] == 'IntentRequest':
-      response = on_intent(alexa_request, alexa_session)
-
-    else:
-      response = build_alexa_response("I received an unexpected request type.")
+    response = on_request(alexa_request, alexa_session)
 
     start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(json.dumps(response))))])
     return [json.dumps(response)]